@@ -0,0 +1,184 @@
+#=============================================================================
+#
+# file :        BlackBoxFile.py
+#
+# description : BlackBox of serial communications stored in a memory-mapped
+#               ring file, it survives crashes of the device server.
+#               Decode a file with: python BlackBoxFile.py filename [last]
+#
+# project :    VacuumController Device Server
+#
+# $Author: srubio@cells.es $
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+import os,sys,time,mmap,struct,itertools
+
+from Clock import monotonic
+
+MAGIC = 'SVDBBOX2' #Version 2: 64 bits sequence numbers
+HEADER = struct.Struct('<8sIII') #magic,slots,cap,methods
+HEADER_SIZE = 256
+METHOD_NAME = 16 #bytes of each method name in the header
+MAX_METHODS = (HEADER_SIZE-HEADER.size)/METHOD_NAME
+OK,EXCEPTION = 0,1
+RECORD = '<QdfBBHH%ds%ds' #seq,epoch,duration,method,outcome,len(request),len(reply),request,reply
+
+def tobytes(value):
+    """ Converts arguments/results of serial commands to a byte string """
+    if isinstance(value,str):
+        return value
+    if isinstance(value,unicode):
+        return value.encode('latin-1','replace')
+    if isinstance(value,(list,tuple,bytearray)) or type(value).__name__=='array':
+        try: return str(bytearray(value)) #DevVarCharArray
+        except: pass
+    return str(value)
+
+class BlackBoxFile(object):
+    """
+    BlackBox that stores the last communications in a memory-mapped ring file
+    of fixed size binary records, so they are kept if the device server dies.
+    It is used as BlackBox (decorator(), save(), to_string())
+    and the file can be decoded afterwards with BlackBoxFile.read(filename).
+
+    Each record contains sequence number, epoch, duration, method, outcome and
+    the request (arguments) and reply (result or exception) truncated to cap bytes.
+
+    Appending does not take any lock: each call gets its own slot from
+    an itertools.count (atomic in CPython) and writes it with a single pack_into.
+    Formatting is done only when reading.
+    Errors while appending are counted (errors) and logged, never raised to the caller.
+    """
+    def __init__(self,filename,size=1000,cap=64):
+        self.filename,self.size,self.cap = filename,size,cap
+        self.record = struct.Struct(RECORD%(cap,cap))
+        self.methods = []
+        self.errors = 0
+        length = HEADER_SIZE+size*self.record.size
+        start = 0
+        if os.path.exists(filename) and os.path.getsize(filename)==length:
+            try:
+                header = BlackBoxFile.read_header(open(filename,'rb').read(HEADER_SIZE))
+                if header[1:3]==(size,cap):
+                    self.methods = header[3]
+                    start = max([r[0] for r in BlackBoxFile.read(filename)] or [-1])+1
+            except ValueError:
+                pass
+        self.file = open(filename,'r+b' if start else 'w+b')
+        if not start:
+            self.file.truncate(length)
+        self.map = mmap.mmap(self.file.fileno(),length)
+        self.write_header()
+        self.counter = itertools.count(start)
+
+    def write_header(self):
+        self.map[:HEADER.size] = HEADER.pack(MAGIC,self.size,self.cap,len(self.methods))
+        for i,m in enumerate(self.methods):
+            offset = HEADER.size+i*METHOD_NAME
+            self.map[offset:offset+METHOD_NAME] = m[:METHOD_NAME].ljust(METHOD_NAME,'\0')
+
+    def append(self,t,method,duration,outcome,request,reply):
+        seq = next(self.counter)
+        self.record.pack_into(self.map,HEADER_SIZE+(seq%self.size)*self.record.size,
+            seq,t,duration,method,outcome,min(len(request),self.cap),min(len(reply),self.cap),request,reply)
+
+    def safe_append(self,t,method,duration,outcome,args,reply):
+        """ append() for the decorator, the black box must not break the call it records """
+        try:
+            self.append(t,method,duration,outcome,'\t'.join(map(tobytes,args)),tobytes(reply))
+        except Exception,e:
+            self.errors += 1
+            if self.errors==1 or not self.errors%1000:
+                print 'BlackBoxFile(%s).append failed (%d errors): %s'%(self.filename,self.errors,e)
+
+    def decorator(self,method):
+        name = method.__name__
+        if name not in self.methods and len(self.methods)<MAX_METHODS:
+            self.methods.append(name)
+            self.write_header()
+        index = self.methods.index(name) if name in self.methods else 255
+        def wrapper(*args,**kwargs):
+            t,t0 = time.time(),monotonic()
+            try:
+                r = method(*args,**kwargs)
+            except Exception,e:
+                self.safe_append(t,index,monotonic()-t0,EXCEPTION,args,e)
+                raise
+            self.safe_append(t,index,monotonic()-t0,OK,args,r)
+            return r
+        wrapper.__name__ = name
+        return wrapper
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def save(self,filename):
+        self.flush()
+        filename = filename.split('.')[0]+time.strftime('_%Y%m%d_%H%M%S.')+'.'+filename.split('.')[-1]
+        open(filename,'w').write(self.to_string())
+        return filename
+
+    def to_string(self):
+        return BlackBoxFile.to_text(BlackBoxFile.read(self.filename))
+
+    @staticmethod
+    def read_header(data):
+        magic,slots,cap,methods = HEADER.unpack(data[:HEADER.size])
+        if magic!=MAGIC:
+            raise ValueError('Not a BlackBoxFile')
+        names = [data[HEADER.size+i*METHOD_NAME:HEADER.size+(i+1)*METHOD_NAME].rstrip('\0')
+            for i in range(methods)]
+        return magic,slots,cap,names
+
+    @staticmethod
+    def read(filename,last=None):
+        """
+        Decodes a BlackBoxFile, returns the list of the last records (all if None)
+        sorted by sequence number as tuples (seq,epoch,duration,method,outcome,request,reply)
+        """
+        data = open(filename,'rb').read()
+        magic,slots,cap,names = BlackBoxFile.read_header(data)
+        record = struct.Struct(RECORD%(cap,cap))
+        result = []
+        for i in range(slots):
+            seq,t,duration,method,outcome,lreq,lrep,req,rep = record.unpack_from(data,HEADER_SIZE+i*record.size)
+            if t:
+                method = names[method] if method<len(names) else str(method)
+                result.append((seq,t,duration,method,('OK','EXCEPTION')[outcome],req[:lreq],rep[:lrep]))
+        return sorted(result)[-last:] if last else sorted(result)
+
+    @staticmethod
+    def to_text(records):
+        return '\n'.join('%d\t%s.%03d\t%2.4f\t%s\t%s\t%r\t%r'%(seq,time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(t)),
+            int(1e3*(t%1)),duration,method,outcome,req,rep) for seq,t,duration,method,outcome,req,rep in records)
+
+if __name__ == '__main__':
+    if not sys.argv[1:]:
+        print 'Usage: python BlackBoxFile.py filename [last]'
+        sys.exit(1)
+    print BlackBoxFile.to_text(BlackBoxFile.read(sys.argv[1],int(sys.argv[2]) if sys.argv[2:] else None))
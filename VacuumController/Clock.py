@@ -0,0 +1,86 @@
+#=============================================================================
+#
+# file :        Clock.py
+#
+# description : Monotonic clock used to schedule serial communications,
+#               it does not jump if the system time is changed, and
+#               cpu time of the current thread.
+#
+# project :    VacuumController Device Server
+#
+# $Author: srubio@cells.es $
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+import sys,time,threading
+
+__all__ = ['monotonic','thread_time']
+
+def _clamped_time(_lock=threading.Lock(),_state=[0.,0.]):
+    """ time.time() that never goes backwards: steps back are absorbed in an offset """
+    with _lock:
+        now = time.time()+_state[1]
+        if now<_state[0]:
+            _state[1] += _state[0]-now
+            now = _state[0]
+        _state[0] = now
+        return now
+
+CLOCK_MONOTONIC,CLOCK_THREAD_CPUTIME_ID = 1,3 #Linux
+
+def _clock_gettime(clock_id):
+    """ Returns a function reading clock_gettime(clock_id) from libc/librt (Linux), None if not available """
+    import ctypes
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec',ctypes.c_long),('tv_nsec',ctypes.c_long)]
+    for lib in ('librt.so.1','libc.so.6'):
+        try: 
+            clock_gettime = ctypes.CDLL(lib,use_errno=True).clock_gettime
+        except (OSError,AttributeError): 
+            continue
+        clock_gettime.argtypes = [ctypes.c_int,ctypes.POINTER(timespec)]
+        def clock():
+            t = timespec() #One per call, the GIL is released while calling
+            if clock_gettime(clock_id,ctypes.byref(t)):
+                raise OSError(ctypes.get_errno(),'clock_gettime failed')
+            return t.tv_sec+t.tv_nsec*1e-9
+        clock()
+        return clock
+    return None
+
+def _linux_clock(clock_id):
+    if not sys.platform.startswith('linux'):
+        return None
+    try: return _clock_gettime(clock_id)
+    except Exception: return None
+
+try: 
+    from time import monotonic
+except ImportError: #Python 2
+    monotonic = _linux_clock(CLOCK_MONOTONIC) or _clamped_time
+
+try: 
+    from time import thread_time
+except ImportError: #Python 2, None if not available
+    thread_time = _linux_clock(CLOCK_THREAD_CPUTIME_ID)
@@ -130,7 +130,7 @@ class IonPump(PseudoDev):
         if att == self.ChannelName.split('[')[0].lower():
             if '[' in self.ChannelName and fun.isSequence(attr_value.value):
                 attr_value.value = attr_value.value[self.getOrdinal(self.ChannelName)]
-            self.Cache[self.ChannelName] = attr_value
+            self.ChannelRecord.update(attr_value)
             self.ChannelValue = attr_value.value
             if attr_value.quality in (PyTango.AttrQuality.ATTR_ALARM,PyTango.AttrQuality.ATTR_WARNING): 
                 new_state = PyTango.DevState.ALARM
@@ -138,14 +138,13 @@ class IonPump(PseudoDev):
                 new_state = PyTango.DevState.STANDBY
             else: 
                 new_state = PyTango.DevState.ON
-            date = attr_value.time if not hasattr(attr_value.time,'totime') else attr_value.time.totime()
-            self.plog('info','Updated Pressure Value: %s at %s'%(attr_value.value,date))
+            self.plog('info','Updated Pressure Value: %s at %s',attr_value.value,self.ChannelRecord.time)
         elif att == 'state':
-            self.Cache[att] = attr_value
+            self.Cache[att].update(attr_value)
         else: 
-            self.plog('warning','UNKNOWN ATTRIBUTE %s!!!!!'%attr_name)
-            self.plog('debug','self.Channel=%s'%str(self.Channel))
-            self.plog('debug','attr_name.split=%s'%str(attr_name.split('/')))
+            self.plog('warning','UNKNOWN ATTRIBUTE %s!!!!!',att)
+            self.plog('debug','self.Channel=%s',self.Channel)
+            self.plog('debug','att=%s',att)
         return new_state
 
 
@@ -183,11 +182,10 @@ class IonPump(PseudoDev):
                 self.ChannelName = fun.first(c for c in self.Channel if not fun.matchCl('(*state*|*status*)',c))
                 targets = ['State',self.ChannelName.split('[')[0]]
                 self.debug('Creating cache values for %s:%s' % (self.IonPumpController,targets))
-                for attribute in targets:
-                    da = PyTango.DeviceAttribute()
-                    da.name,da.time,da.value = (self.IonPumpController+'/'+attribute),PyTango.TimeVal.fromtimestamp(0),None
-                    self.Cache[attribute] = da
-                    self.Errors[attribute] = 0
+                self.create_cache(self.IonPumpController,targets)
+                if self.ChannelName not in self.Cache: #Channel[index]
+                    self.create_cache(self.IonPumpController,[self.ChannelName])
+                self.ChannelRecord = self.Cache[self.ChannelName]
                 
                 self.subscribe_external_attributes(self.IonPumpController,targets)
             
@@ -249,8 +247,7 @@ class IonPump(PseudoDev):
             quality=PyTango.AttrQuality.ATTR_INVALID
         
         #value,date = self.ChannelValue,self.ChannelDate
-        av = self.Cache[self.ChannelName]
-        value,date = av.value,av.time if not hasattr(av.time,'totime') else av.time.totime()
+        value,date = self.ChannelRecord.get()[:2]
         self.debug('read_Pressure(): state is %s, value is %s, quality is %s.'%(state,value,quality))
         if 'set_attribute_value_date_quality' in dir(PyTango):
             PyTango.set_attribute_value_date_quality(attr,float(value),date,quality)
@@ -348,7 +345,7 @@ class IonPump(PseudoDev):
         state=self.get_state()
         if str(state)=='ON':
             quality=PyTango.AttrQuality.ATTR_VALID
-            value = '%3.2e mbar'%(self.Cache[self.ChannelName].value)
+            value = '%3.2e mbar'%(self.ChannelRecord.value)
         else:
             quality=PyTango.AttrQuality.ATTR_ALARM
             value = str(state)
@@ -434,6 +431,10 @@ class IonPumpClass(PyTango.PyDeviceClass):
             [PyTango.DevBoolean,
             "true/false",
             [False] ],
+        'CoalesceEvents':
+            [PyTango.DevBoolean,
+            "If true, events are processed in a separate thread and only the last event of each attribute is kept while waiting",
+            [False] ],
         'PollingCycle': #2013, added from PyStateComposer
             [PyTango.DevLong,
             "Default period for polling all device states.",
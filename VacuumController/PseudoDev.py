@@ -45,7 +45,7 @@
 ##########################################################################
 #
 
-import sys, time, traceback, re
+import sys, time, traceback, re, threading, collections, atexit
 import PyTango
 from PyTango import DevState
 
@@ -56,6 +56,188 @@ import fandango.device as device
 from fandango.device import Dev4Tango,attr2str,fakeAttributeValue, fakeEventType
 from fandango import callbacks
 
+LOG_LEVELS = {'debug':10,'info':20,'warning':30,'error':40}
+
+class AsyncLog(object):
+    """
+    Writes the log of all PseudoDev devices from a single thread,
+    so event_received does not wait for stdout.
+
+    write() only appends a (time,prio,name,format,args) tuple to a deque
+    (atomic in CPython, no lock is taken); the message is formatted and printed
+    by the writer thread. Records arriving when MAX_QUEUE records are pending
+    are dropped, the number of dropped records is printed by the writer.
+    """
+    __instance = None
+    MAX_QUEUE = 10000
+    PERIOD = .1
+
+    @classmethod
+    def get_instance(cls):
+        if cls.__instance is None:
+            cls.__instance = cls()
+        return cls.__instance
+
+    def __init__(self,stream=None,maxsize=MAX_QUEUE,period=PERIOD):
+        self.stream = stream #sys.stdout if None
+        self.maxsize,self.period = maxsize,period
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.written = 0
+        self.dropped = 0
+        self.reported = 0
+
+    def write(self,prio,name,s,args=()):
+        if len(self.queue)>=self.maxsize:
+            self.dropped += 1
+            return
+        self.queue.append((time.time(),prio,name,s,args))
+        if self.thread is None: 
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(None,self.run,'AsyncLog')
+                self.thread.setDaemon(True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            try: self.flush()
+            except: traceback.print_exc()
+            time.sleep(self.period)
+
+    def flush(self):
+        """ Formats and prints all pending records """
+        lines = []
+        while self.queue:
+            t,prio,name,s,args = self.queue.popleft()
+            if args:
+                try: s = s%args
+                except Exception,e: s = '%s %% %r (%s)'%(s,args,e)
+            lines.append('%s %s %s: %s\n'%(prio.upper(),time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(t)),name,s))
+        if self.dropped!=self.reported:
+            lines.append('WARNING %s AsyncLog: %d records dropped, queue full\n'%(
+                time.strftime('%Y-%m-%d %H:%M:%S',time.localtime()),self.dropped-self.reported))
+            self.reported = self.dropped
+        if lines:
+            stream = self.stream or sys.stdout
+            stream.write(''.join(lines))
+            stream.flush()
+            self.written += len(lines)
+
+class EventCoalescer(object):
+    """
+    Latest-wins queue of the events received by a PseudoDev (see CoalesceEvents property).
+
+    push() keeps only the newest event of each key (attribute and event type), replacing 
+    the pending one; replaced events are counted (dropped) and timestamped (last_dropped).
+    A worker thread calls process(*args) for the pending event of each key,
+    in the order their last event arrived, so a burst of events costs a single
+    state evaluation per attribute and the newest event is processed last.
+    """
+    def __init__(self,process,name='EventCoalescer'):
+        self.process = process
+        self.slots = {} #key: (first received,last received,args)
+        self.condition = threading.Condition()
+        self.received = 0
+        self.processed = 0
+        self.dropped = {} #key: events replaced before being processed
+        self.last_dropped = {} #key: time of the last replaced event
+        self.stopped = False
+        self.thread = threading.Thread(None,self.run,name)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def push(self,key,*args):
+        with self.condition:
+            now = time.time()
+            first = now
+            if key in self.slots:
+                first = self.slots[key][0]
+                self.dropped[key] = self.dropped.get(key,0)+1
+                self.last_dropped[key] = now
+            self.slots[key] = (first,now,args)
+            self.received += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.slots and not self.stopped:
+                    self.condition.wait(1.)
+                if self.stopped:
+                    break
+                pending,self.slots = self.slots,{}
+            for key,(first,last,args) in sorted(pending.items(),key=lambda i:i[1][1]):
+                try: self.process(*args)
+                except: traceback.print_exc()
+                self.processed += 1
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notifyAll()
+
+    def get_report(self):
+        return '%d events received, %d processed, %d coalesced'%(
+            self.received,self.processed,sum(self.dropped.values()))
+
+class CacheRecord(object):
+    """
+    Last value of an external attribute in PseudoDev.Cache, used instead of a DeviceAttribute.
+
+    value, time (epoch, converted once when written), quality and errors are kept 
+    in a single tuple (data) replaced at once, so a reader always gets a consistent 
+    snapshot with get() without locking, as long as a single thread writes the record.
+    """
+    __slots__ = ('name','data')
+    
+    def __init__(self,name,value=None,time=0,quality=None,errors=0):
+        self.name = name
+        self.data = (value,time,quality,errors)
+        
+    def get(self):
+        """ Returns (value,time,quality,errors) """
+        return self.data
+        
+    def set(self,value,time,quality=None):
+        """ time can be epoch or TimeVal """
+        self.data = (value,time.totime() if hasattr(time,'totime') else (time or 0),quality,self.data[3])
+        
+    def update(self,attr_value):
+        """ Copies value, time and quality of a DeviceAttribute or fakeAttributeValue """
+        self.set(attr_value.value,attr_value.time,getattr(attr_value,'quality',None))
+        
+    def _replace(self,i,v):
+        data = list(self.data)
+        data[i] = v
+        self.data = tuple(data)
+
+    value = property(lambda self:self.data[0],lambda self,v:self._replace(0,v))
+    time = property(lambda self:self.data[1],lambda self,v:self._replace(1,v.totime() if hasattr(v,'totime') else v))
+    quality = property(lambda self:self.data[2],lambda self,v:self._replace(2,v))
+    errors = property(lambda self:self.data[3],lambda self,v:self._replace(3,v))
+
+class EventRoute(object):
+    """
+    Names of an event source, parsed once and kept in PseudoDev.EventRoutes
+    instead of parsing the model on every event (see PseudoDev.get_event_route)
+    """
+    __slots__ = ('source','tango_host','dev_name','att','attr_name','error_value')
+    
+    def __init__(self,source):
+        self.source = fandango.tango.get_model_name(source).lower()
+        params = fandango.tango.parse_tango_model(self.source)
+        self.tango_host = '%s:%s'%(params['host'],params['port'])
+        self.dev_name,self.att = params['devicename'],params['attributename']
+        self.attr_name = '%s/%s'%(self.dev_name,self.att)
+        #Value set in Cache when MAX_ERRORS is reached
+        self.error_value = {'state':None,'channelstate':'UNKNOWN'}.get(self.att)
+
 class PseudoDev(Dev4Tango):
     """ 
     Tango pseudo-Abstract Class for Ion Pumps, it's a firendly and minimalistic interface to each of the pumps managed through a DUAL or Splitter Device Server.
@@ -64,6 +246,7 @@ class PseudoDev(Dev4Tango):
     Last update: srubio@cells.es, 2010/10/18
     """
     MAX_ERRORS = 3
+    plog_level = 0 #LOG_LEVELS value of LogLevel, set in init_device
     
     def set_state(self,state,reason='',push=True):
         Dev4Tango.set_state(self,state)
@@ -80,8 +263,9 @@ class PseudoDev(Dev4Tango):
         self.init_my_Logger()
         
         self.state_error,self.init_error,self.event_status='','',''
-        self.Cache = fandango.CaselessDict() #A cache is needed to avoid timeouts affecting always_hook and read_attributes
+        self.Cache = fandango.CaselessDict() #A cache is needed to avoid timeouts affecting always_hook and read_attributes (see create_cache)
         self.Errors = fandango.CaselessDict()
+        self.EventRoutes = {} #Event source (object or model) -> EventRoute, rebuilt on Init
         self.state_reason = 'Device not initialized'      
         self.last_event_received = 0
         self.ChannelStatus = ''
@@ -92,6 +276,44 @@ class PseudoDev(Dev4Tango):
         self.info( "In "+self.get_name()+"::init_device()" )
         self.set_state(PyTango.DevState.INIT)
         self.get_device_properties(self.get_device_class())
+        self.plog_level = LOG_LEVELS.get(str(self.LogLevel).lower(),0)
+        if getattr(self,'Coalescer',None) is not None: 
+            self.Coalescer.stop()
+        self.Coalescer = EventCoalescer(self.process_event,'%s.EventCoalescer'%self.get_name()) \
+            if getattr(self,'CoalesceEvents',False) else None
+        
+    def create_cache(self,device,attributes):
+        """ Creates an empty CacheRecord and resets the Errors of each attribute of device """
+        for attribute in attributes:
+            self.Cache[attribute] = CacheRecord(device+'/'+attribute)
+            self.Errors[attribute] = 0
+        return [self.Cache[a] for a in attributes]
+        
+#------------------------------------------------------------------
+#    Event sources routing
+#------------------------------------------------------------------
+    def subscribe_external_attributes(self,device,attributes):
+        """ Prepares the EventRoute of each attribute before subscribing """
+        for attribute in attributes:
+            model = ('%s/%s'%(device,attribute)).lower()
+            try: self.EventRoutes[model] = EventRoute(model)
+            except Exception,e: self.warning('Unable to parse %s: %s'%(model,e))
+        return Dev4Tango.subscribe_external_attributes(self,device,attributes)
+        
+    def get_event_route(self,source):
+        """ Returns the EventRoute of an event source, the model is parsed only the first time """
+        try: 
+            return self.EventRoutes[source]
+        except (KeyError,TypeError): #Not seen yet or unhashable
+            pass
+        model = fandango.tango.get_model_name(source).lower()
+        route = self.EventRoutes.get(model) or self.EventRoutes.get(re.sub('^(tango://)?[^/]*:[0-9]+/','',model))
+        if route is None:
+            route = EventRoute(model)
+        self.EventRoutes[model] = route
+        try: self.EventRoutes[source] = route
+        except TypeError: pass
+        return route
         
 #------------------------------------------------------------------
 #    Device destructor
@@ -99,6 +321,8 @@ class PseudoDev(Dev4Tango):
     def delete_device(self):
         print "[Device delete_device method] for device",self.get_name()
         self.unsubscribe_external_attributes()
+        if getattr(self,'Coalescer',None) is not None: 
+            self.Coalescer.stop()
         
 #------------------------------------------------------------------
 #    Always excuted hook method
@@ -126,33 +350,45 @@ class PseudoDev(Dev4Tango):
 #------------------------------------------------------------------
 #    Event Received Hook
 #------------------------------------------------------------------
-    def plog(self,prio,s):
-        print '%s %s %s: %s' % (prio.upper(),time.strftime('%Y-%m-%d %H:%M:%S',time.localtime()),self.get_name(),s)
+    def plog(self,prio,s,*args):
+        """ Logs s%args through AsyncLog if prio is not below LogLevel, s is formatted by the writer thread """
+        if LOG_LEVELS.get(prio,40)>=self.plog_level:
+            AsyncLog.get_instance().write(prio,self.get_name(),s,args)
         
     def event_received(self,source,type_,attr_value):
+        """
+        Events are processed by process_event, in the EventCoalescer thread if CoalesceEvents is True
+        """
+        self.last_event_received = time.time()
+        if getattr(self,'Coalescer',None) is not None:
+            try: key = self.get_event_route(source).attr_name
+            except: key = str(source)
+            #Config events must not replace pending values (and vice versa)
+            self.Coalescer.push((key,type_),source,type_,attr_value)
+        else:
+            self.process_event(source,type_,attr_value)
+        
+    def process_event(self,source,type_,attr_value):
         """
         This function manages the States of the device
         Initializes ChannelValue and ChannelStatus to keep the values of attributes
         """
-        self.last_event_received = time.time()
         #self.info,debug,error,warning should not be used here to avoid conflicts with tau.core logging
         log = self.plog
         if type_ not in fakeEventType and fn.isString(type_):
             type_ = fn.matchMap(fakeEventType.lookup,'change',default=0)
         log('info','*'*80)
-        log('info','In .event_received(%s(%s),%s,%s)'%(type(source).__name__,source,type_,type(attr_value).__name__))
+        log('info','In .event_received(%s(%s),%s,%s)',type(source).__name__,source,type_,type(attr_value).__name__)
         if fakeEventType[type_] == 'Config': return
-        source = fandango.tango.get_model_name(source)
-        params = fandango.tango.parse_tango_model(source)
-        tango_host,dev_name,att,attr_name = '%s:%s'%(params['host'],params['port']),\
-            params['devicename'],params['attributename'],'%s/%s'%(params['devicename'],params['attributename'])
+        route = self.get_event_route(source)
+        source,dev_name,att,attr_name = route.source,route.dev_name,route.att,route.attr_name
         error = ('Error'==fakeEventType[type_])
         try:
             #Get actual State
             state = new_state = self.get_state() 
             if att == 'state' and not error: dState = attr_value.value
             else: dState = self.Cache['state'].value
-            log('info','In .event_received(%s): parent state is %s'%(source,dState))
+            log('info','In .event_received(%s): parent state is %s',source,dState)
             
             if dState not in (None,PyTango.DevState.INIT,PyTango.DevState.UNKNOWN):
                 if not error:
@@ -165,16 +401,16 @@ class PseudoDev(Dev4Tango):
                         else:
                             self.Errors[att] = 0
                     else:
-                        log('warning','event_received(%s,%s): no further actions for this value type ... %s' % (source,fakeEventType[type_],type(attr_value)))
+                        log('warning','event_received(%s,%s): no further actions for this value type ... %s',source,fakeEventType[type_],type(attr_value))
                 elif error:
                     self.Errors[att] += 1
                     try: reasons = [e.reason for e in attr_value.args]
                     except: reasons = []
-                    error_value = {'state':None,self.Channel:None,'channelstate':'UNKNOWN'}.get(att,None)
+                    error_value = route.error_value
                     #if any([r in err_reason for r in #Discarding well-known common Exceptions
                         #['MKS','VarianDUAL','API_AttributeFailed','AttrNotAllowed','TimeOut','Timeout']]):
                         #print 'In IonPump(%s).push_event(%s): Attribute Reading not allowed (%s)'%(self.get_name(),att_name,err_reason)                    
-                    log('warning','In event_received(%s) ... received an error! %d/%d: \n%s '%(source,self.Errors[att],self.MAX_ERRORS,reasons))
+                    log('warning','In event_received(%s) ... received an error! %d/%d: \n%s ',source,self.Errors[att],self.MAX_ERRORS,reasons)
                     if self.Errors[att]>=self.MAX_ERRORS: 
                         self.state_reason ='MAX_ERRORS limit (%d) reached for attribute %s, resetting the value to %s' % (self.MAX_ERRORS,attr_name,error_value) 
                         if self.Cache[att].value!=error_value: log('warning',self.state_reason)
@@ -187,7 +423,7 @@ class PseudoDev(Dev4Tango):
             #If not able to read Controller's State
             else:
                 #In UNKNOWN State is assumed that is useless to communicate with the Parent device
-                log('debug','In .event_received(%s): %s.State is %s, events are ignored.'%(source,dev_name,dState))
+                log('debug','In .event_received(%s): %s.State is %s, events are ignored.',source,dev_name,dState)
                 new_state=PyTango.DevState.UNKNOWN # Use of states other than UNKNOWN is confussing and unpredictable!
                 self.state_reason = '%s state is %s'%(dev_name,dState if dState is not None else 'NotRunning')
                 self.ChannelValue = None
@@ -206,16 +442,20 @@ class PseudoDev(Dev4Tango):
                 self.state_error=str(e).replace('\n','')[:80]+'...'
             log('error',(message))
             self.Errors[att] += 1
-            error_value = {'state':None,self.Channel:None,'channelstate':'UNKNOWN'}.get(att,None)
+            error_value = route.error_value
             if self.Errors[att]>=self.MAX_ERRORS and self.Cache[att].value!=error_value:
-                log('warning','MAX_ERRORS limit (%d) reached for attribute %s, resetting the value to %s' % (self.MAX_ERRORS,attr_name,error_value))
+                log('warning','MAX_ERRORS limit (%d) reached for attribute %s, resetting the value to %s',self.MAX_ERRORS,attr_name,error_value)
                 self.Cache[att].value = error_value
                 if att=='state': new_state = PyTango.DevState.UNKNOWN
             
+        if att in self.Cache and att in self.Errors:
+            self.Cache[att].errors = self.Errors[att]
         if new_state!=state:
-            log('info','State Changed!!! %s -> %s'%(state,new_state))
+            log('info','State Changed!!! %s -> %s',state,new_state)
             self.set_state(new_state)
         self.event_status = 'Last event received at %s'%time.ctime(self.last_event_received)
-        log('debug','Out of .event_received(%s) ...........'%(source))
+        if getattr(self,'Coalescer',None) is not None:
+            self.event_status += ' (%s)'%self.Coalescer.get_report()
+        log('debug','Out of .event_received(%s) ...........',source)
         log('debug','*'*80)        
         
@@ -0,0 +1,164 @@
+#=============================================================================
+#
+# file :        SerialBenchmark.py
+#
+# description : Micro-benchmarks of the SerialVacuumDevice and PseudoDev hot paths,
+#               run it with: python SerialBenchmark.py
+#
+# project :    VacuumController Device Server
+#
+# $Author: srubio@cells.es $
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+import sys,time,timeit
+
+from SerialVacuumDevice import SerialVacuumDevice,LatencyStats,getExpNumbers,decodeChannels,decodeReplies,stripReply
+from SerialEmulator import SerialEmulator
+
+## Replies recorded from controllers in the field
+REPLIES = [
+    '0,1.0500E-09,0,2.3400E-10,0,4.0000E-11,0,1.1200E-09,0,8.9000E-10,0,1.0000E-02', #MaxiGauge PRX
+    '1.0E-09 OFF LO<1.0E-11 ?', #MKS 937 PR1-4
+    '5.2E-10,4.1E-10,!,OFF', #Dual P? (OK,OK,error,off)
+    '+3.4000E-09', #Single channel
+    ]
+
+def bench_decoding(replies=REPLIES,number=10000,out=sys.stdout):
+    """
+    Compares getExpNumbers against decodeChannels/decodeReplies, 
+    returns a dict with the microseconds per reply of each method.
+    
+    Replies are decoded one by one and, for the batch decoding, 
+    as a batch of replies with the same channels (e.g. a MaxiGauge polled every cycle).
+    """
+    batch = [replies[0]]*len(replies)
+    tests = [
+        ('getExpNumbers',lambda: [getExpNumbers(r) for r in replies]),
+        ('decodeChannels',lambda: [decodeChannels(r) for r in replies]),
+        ('getExpNumbers(batch)',lambda: [getExpNumbers(r) for r in batch]),
+        ('decodeReplies(batch)',lambda: decodeReplies(batch)),
+        ]
+    results = {}
+    for k,f in tests:
+        results[k] = 1e6*timeit.Timer(f).timeit(number)/(number*len(replies))
+        if out: out.write('%s: %2.2f us/reply\n'%(k,results[k]))
+    return results
+
+def legacyStripReply(result,commCode,blanks):
+    """ Character by character version of stripReply used up to VacuumController 4.5, for comparison """
+    for c in reversed(result):
+        if c not in blanks: break
+        result=result[0:len(result)-1]
+    if commCode in result:
+        while len(commCode) and len(result) and commCode[0]==result[0]:
+            commCode=commCode[1:]
+            result=result[1:]
+    for c in result:
+        if c not in blanks: break
+        result=result[1:]
+    return result,commCode
+
+def bench_framing(channels=(6,24,96),number=2000,out=sys.stdout):
+    """
+    Compares stripReply against the legacy character by character cleanup 
+    on echoed MaxiGauge-like replies with the given number of channels,
+    returns a dict with the microseconds per reply of each method.
+    """
+    blanks = set([ '\n', '\r', ' ', '>' ])
+    results = {}
+    for n in channels:
+        command = 'PRX\r'
+        reply = command+'\r\n  '+','.join(['0,1.0500E-09']*n)+' \r\n>'
+        for name,method in (('legacy',legacyStripReply),('stripReply',stripReply)):
+            k = '%s(%d channels)'%(name,n)
+            results[k] = 1e6*timeit.Timer(lambda: method(reply,command,blanks)).timeit(number)/number
+            if out: out.write('%s: %2.2f us/reply\n'%(k,results[k]))
+    return results
+
+def bench_events(models=('tango://alba01:10000/lab/vc/ipct-01/p1','lab/vc/ipct-01/State',
+        'lab/vc/ipct-01/ChannelState'),number=10000,out=sys.stdout):
+    """
+    Compares the cost per event of parsing the event source (as PseudoDev.event_received
+    did on every event) against PseudoDev.get_event_route, returns microseconds per event.
+    """
+    from PseudoDev import PseudoDev,EventRoute
+    class Device(object): #PseudoDev attributes used by get_event_route
+        EventRoutes = {}
+        get_event_route = PseudoDev.__dict__['get_event_route']
+    device = Device()
+    results = {}
+    results['parse'] = 1e6*timeit.Timer(
+        lambda: [EventRoute(m) for m in models]).timeit(number)/(number*len(models))
+    results['get_event_route'] = 1e6*timeit.Timer(
+        lambda: [device.get_event_route(m) for m in models]).timeit(number)/(number*len(models))
+    if out:
+        for k in ('parse','get_event_route'):
+            out.write('%s: %2.2f us/event\n'%(k,results[k]))
+    return results
+
+def bench_updatehw(commands=8,duration=5.,period=.01,wait=.5,out=sys.stdout,
+        emulator={},device={}):
+    """
+    Polls commands read commands of a SerialEmulator for duration seconds,
+    returns a dict with readings per second, failed transactions, remote calls
+    and percentiles of the transaction latency (seconds).
+    
+    :param emulator: SerialEmulator arguments (latency, jitter, drop, garble, echo, ...)
+    :param device: SerialVacuumDevice arguments (lean, reader, learn, breaker, ...)
+    """
+    replies = dict(('PR%d'%i,REPLIES[i%len(REPLIES)]) for i in range(commands))
+    proxy = SerialEmulator(replies,**emulator)
+    svd = SerialVacuumDevice('emulated/serial/bench',period=period,wait=wait,
+        log='ERROR',proxy=proxy,**device)
+    svd.setFraming(proxy.terminator)
+    for k in sorted(replies): svd.addComm(k)
+    latency,failed = LatencyStats(1,0,wait,size=1000000),[0]
+    serialComm = svd.serialComm
+    def timed(*args):
+        t0 = time.time()
+        try: result = serialComm(*args)
+        except: result = ''
+        if result: latency.add(time.time()-t0)
+        else: failed[0] += 1
+        return result
+    svd.serialComm = timed
+    svd.start()
+    time.sleep(duration)
+    svd.stop()
+    results = {'readings/s':latency.count/duration,'failed':failed[0],'dpcalls':proxy.calls,
+        'p50':latency.percentile(50),'p99':latency.percentile(99),'max':latency.percentile(100)}
+    if out:
+        out.write('updateHW(%d commands,%s,%s): %s\n'%(commands,emulator,device,
+            ', '.join('%s=%s'%(k,'%2.4f'%v if isinstance(v,float) else v) for k,v in sorted(results.items()))))
+    return results
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if sys.argv[1:] else 10000
+    bench_decoding(number=number)
+    bench_framing(number=number/5)
+    bench_events(number=number)
+    duration = number/2000.
+    bench_updatehw(duration=duration)
+    bench_updatehw(duration=duration,device={'lean':True})
+    bench_updatehw(duration=duration,emulator={'jitter':.003,'drop':.02,'garble':.02},device={'learn':3})
@@ -0,0 +1,211 @@
+#=============================================================================
+#
+# file :        SerialEmulator.py
+#
+# description : Emulates a serial line and its controller, it can be used
+#               as DeviceProxy of SerialVacuumDevice to test it without hardware.
+#
+# project :    VacuumController Device Server
+#
+# $Author: srubio@cells.es $
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+import time,random,threading
+from TrafficRecorder import TrafficRecorder
+
+class EmulatorInfo(object):
+    def __init__(self,dev_class):
+        self.dev_class = dev_class
+
+class EmulatorValue(object):
+    def __init__(self,value):
+        self.value = value
+
+class SerialEmulator(object):
+    """
+    Fake DeviceProxy of a Serial (ESRF) or PySerial (ALBA) device with a controller attached:
+
+        SerialVacuumDevice('emulated/serial/1',proxy=SerialEmulator({'PR1':'0,1.0E-09'}))
+
+    Each command written is answered (after latency +/- jitter seconds) with
+    replies[command]+terminator; replies values can be also methods f(command)->reply.
+    Unknown commands are not answered, unless nack is set.
+
+    If enquiry is set (e.g. Pfeiffer ACK/ENQ protocol, see PostCommand in SerialVacuumDevice)
+    known commands are answered with ack and the reply is sent when enquiry is received.
+
+    :param echo: the command is echoed before the reply
+    :param drop: probability of not answering a command
+    :param garble: probability of replacing a byte of the reply by a random one
+    """
+    def __init__(self,replies=None,latency=.005,jitter=0.,drop=0.,garble=0.,echo=False,
+            terminator='\r\n',dev_class='Serial',enquiry=None,ack='\x06',nack=None,seed=None):
+        self.replies = replies if replies is not None else {}
+        self.latency,self.jitter,self.drop,self.garble = latency,jitter,drop,garble
+        self.echo,self.terminator,self.dev_class = echo,terminator,dev_class
+        self.enquiry,self.ack,self.nack = enquiry,ack,nack
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.output = [] #(time available,bytes) pending to be read
+        self.last = None #Last command acknowledged (enquiry protocol)
+        self.commands = 0
+        self.dropped = 0
+        self.garbled = 0
+        self.calls = 0
+
+    def info(self):
+        return EmulatorInfo(self.dev_class)
+
+    def ping(self):
+        self.calls += 1
+        return 0
+
+    def state(self):
+        self.calls += 1
+        try: 
+            from PyTango import DevState
+            return DevState.ON
+        except ImportError:
+            return 'ON'
+
+    def read_attribute(self,name):
+        self.calls += 1
+        if name.lower()=='inputbuffer':
+            return EmulatorValue(len(self.available()))
+        raise Exception('SerialEmulator_UnknownAttribute: %s'%name)
+
+    def command_inout(self,name,argin=None):
+        self.calls += 1
+        if name in ('DevSerWriteChar','Write'):
+            self.write(''.join(map(chr,argin)))
+        elif name=='DevSerWriteString':
+            self.write(argin)
+        elif name=='DevSerReadString':
+            return self.read()
+        elif name=='Read':
+            return self.read(argin)
+        elif name in ('DevSerFlush','FlushInput'):
+            with self.lock: self.output = []
+        elif name not in ('Open','Close','FlushOutput'):
+            raise Exception('SerialEmulator_UnknownCommand: %s'%name)
+
+    def reply(self,command):
+        """ Returns the reply to a command, None if not answered """
+        if self.enquiry is not None:
+            if command==self.enquiry:
+                command,self.last = self.last,None
+            elif command in self.replies:
+                self.last = command
+                return self.ack
+            else:
+                return self.nack
+        if command not in self.replies:
+            return self.nack
+        r = self.replies[command]
+        return r(command) if callable(r) else r
+
+    def write(self,data):
+        command = data.strip('\r\n')
+        now = time.time()
+        with self.lock:
+            self.commands += 1
+            reply = self.reply(command)
+            if reply is not None and self.drop and self.random.random()<self.drop:
+                reply,self.dropped = None,self.dropped+1
+            if reply is not None:
+                reply += self.terminator
+                if self.garble and self.random.random()<self.garble:
+                    i = self.random.randrange(len(reply))
+                    reply = reply[:i]+chr(self.random.randrange(256))+reply[i+1:]
+                    self.garbled += 1
+            if self.echo:
+                self.output.append((now,data))
+            if reply is not None:
+                delay = max(0,self.latency+self.random.uniform(-self.jitter,self.jitter))
+                self.output.append((now+delay,reply))
+
+    def available(self):
+        now,result = time.time(),''
+        with self.lock:
+            for t,data in self.output:
+                if t>now: break #Serial line is FIFO
+                result += data
+        return result
+
+    def read(self,size=None):
+        """ Returns the bytes already received (up to size) """
+        now,result = time.time(),''
+        with self.lock:
+            while self.output and self.output[0][0]<=now and (size is None or len(result)<size):
+                t,data = self.output.pop(0)
+                if size is not None and len(result)+len(data)>size:
+                    data,rest = data[:size-len(result)],data[size-len(result):]
+                    self.output.insert(0,(t,rest))
+                result += data
+        return result
+
+class TrafficReplay(SerialEmulator):
+    """
+    SerialEmulator that answers the commands recorded by a TrafficRecorder, 
+    in the recorded order (restarting when exhausted) and with the recorded
+    duration multiplied by speed as latency (speed=0 for as fast as possible).
+    Failed or empty transactions are not answered.
+    
+    run() sends the recorded commands through SerialVacuumDevice.serialComm 
+    and compares the replies with the recorded ones.
+    """
+    def __init__(self,filename,speed=1.,**kwargs):
+        self.records = TrafficRecorder.read(filename)
+        self.speed = speed
+        self.index = {}
+        replies = {}
+        for t,duration,read,ok,command,reply in self.records:
+            replies.setdefault(command.strip('\r\n'),[]).append((duration,reply if ok else None))
+        self.recorded = replies
+        SerialEmulator.__init__(self,dict((k,self.next) for k in replies),latency=0,**kwargs)
+        
+    def next(self,command):
+        """ Returns the next recorded reply of command, sets the latency of the emulator """
+        i = self.index.get(command,0)
+        self.index[command] = (i+1)%len(self.recorded[command])
+        duration,reply = self.recorded[command][i]
+        self.latency = self.speed*duration
+        return reply or None #Nothing was received
+        
+    def run(self,svd,realtime=False,PostCommand=[]):
+        """
+        Sends all recorded commands through svd.serialComm (svd must use this object as proxy),
+        waiting the recorded interval between commands if realtime is True.
+        Returns a list of (command,recorded reply,reply) for the read commands with a different reply.
+        """
+        mismatches = []
+        start,first = time.time(),self.records[0][0] if self.records else 0
+        for t,duration,read,ok,command,reply in self.records:
+            if realtime:
+                time.sleep(max(0,start+t-first-time.time()))
+            try: result = svd.serialComm(command,read,PostCommand)
+            except Exception,e: result = None
+            if read and (result if ok else None)!=(reply if ok else None):
+                mismatches.append((command,reply if ok else None,result))
+        return mismatches
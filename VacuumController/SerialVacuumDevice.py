@@ -31,12 +31,20 @@
 ##########################################################################
 
 
-import threading,re,time,sys,traceback,gc,collections
+import threading,re,time,sys,os,traceback,gc,collections,heapq,itertools,array,string,bisect
 from TangoDev import TangoDev
+from UpdateEngine import UpdateEngine
+from BlackBoxFile import BlackBoxFile
+from TrafficRecorder import TrafficRecorder
 import PyTango, fandango
 from fandango import Logger
 from PyTango import DevState,DevFailed
 
+from Clock import monotonic
+
+try: import numpy
+except ImportError: numpy = None
+
 # ---------------------------------------------------------------
 #    Static methods of the module
 # ---------------------------------------------------------------
@@ -54,15 +62,15 @@ def getExpNumbers(numstring):
     r'...' means that it is interpreted as a raw string (w/o newlines and things like that)
     (exp)? means 0 or 1 matches, (exp)+ means matches >=1, (exp)* means matches >=0
     """
-    regexp = r'([+-]?[0-9]+([.][0-9]+)?([Ee][+-]?[0-9]+([.][0-9]+)?)?)'
+    regexp = EXP_NUMBER
     trace = False
-    if re.search(regexp,numstring): 
+    if regexp.search(numstring): 
         #.group() and .group(0) is the first match, groups()[0] will not give the same!
         # the match group is a list with all the independent matches within the regexp, we take only the first (main)
         # re.match matches the beginning, re.search matches any point, re.findall gives a list with all the matches (each one is a group)
         #cadena = re.search(regexp,numstring).group(0)
         result = []
-        matches = re.findall(regexp,numstring)
+        matches = regexp.findall(numstring)
         if trace: self.debug('Matches are '+str(len(matches))+':'+str(matches)+';'+str(matches[0]))
         for m in matches:
             cadena = m[0] #The first match, the first group
@@ -73,6 +81,93 @@ def getExpNumbers(numstring):
         return result
     else: return None
 
+EXP_NUMBER = re.compile(r'([+-]?[0-9]+([.][0-9]+)?([Ee][+-]?[0-9]+([.][0-9]+)?)?)')
+## Tokens that are not numbers (status codes like ?,!,OFF,LO<1E-11) are replaced by nan
+INVALID_TOKEN = re.compile(r'(?<![^ ])(?![+-]?[0-9]+(\.[0-9]*)?([Ee][+-]?[0-9]+)?(?: |$))[^ ]+')
+NEWLINES = string.maketrans('\r\n','  ')
+FIELD_SEPARATOR = re.compile(r' *[,;\t] *')
+NUMBER_CHARS = '0123456789eE+-. '
+
+def splitChannels(reply):
+    """
+    Returns the channels of a reply separated by single spaces; if the reply has 
+    field separators (,;\\t) empty fields are kept as nan, so channel positions 
+    do not change (e.g. "0,1.0,,2" is "0 1.0 nan 2").
+    """
+    text = str(reply).translate(NEWLINES).strip(' ')
+    if FIELD_SEPARATOR.search(text):
+        return ' '.join((' '.join(f.split()) or 'nan') for f in FIELD_SEPARATOR.split(text))
+    return ' '.join(text.split())
+
+def parseFloats(tokens):
+    """ Converts each token to float, tokens that are not numbers are nan """
+    values = []
+    for t in tokens:
+        try: values.append(float(t))
+        except ValueError: values.append(float('nan'))
+    return values
+
+def decodeChannels(reply):
+    """
+    Decodes a multi-channel reply (e.g. "0,1.0E-05,0,2.3E-03" or "1.0E-09 OFF LO") 
+    and returns (values,valid):
+    
+        values: float array, invalid or status tokens are set to nan
+        valid: boolean array, False for invalid tokens
+        
+    Arrays are numpy arrays if numpy is available, lists otherwise.
+    Empty fields are nan (see splitChannels).
+    The invalid tokens regexp is applied only if the reply contains non-numeric characters.
+    """
+    text = splitChannels(reply)
+    if text.translate(None,NUMBER_CHARS):
+        text = INVALID_TOKEN.sub('nan',text)
+    if numpy is not None:
+        values = numpy.fromstring(text,sep=' ') if text else numpy.zeros(0)
+        if len(values)!=len(text.split()): #Malformed numbers, e.g. "." or "E"
+            values = numpy.array(parseFloats(text.split()),dtype=float)
+        return values,~numpy.isnan(values)
+    values = parseFloats(text.split())
+    return values,[v==v for v in values]
+
+def decodeReplies(replies):
+    """
+    Decodes a batch of replies with the same number of channels in a single pass,
+    returns (values,valid) 2D arrays with a row per reply (see decodeChannels).
+    Replies with different number of channels are decoded one by one and padded with nan.
+    """
+    replies = [splitChannels(r) for r in replies]
+    rows = len(replies)
+    if numpy is not None and rows and all(r and r.count(' ')==replies[0].count(' ') 
+            for r in replies):
+        values,valid = decodeChannels(' '.join(replies))
+        return values.reshape(rows,-1),valid.reshape(rows,-1)
+    decoded = [decodeChannels(r) for r in replies]
+    width = max([len(v) for v,m in decoded] or [0])
+    values = [list(v)+[float('nan')]*(width-len(v)) for v,m in decoded]
+    valid = [list(m)+[False]*(width-len(m)) for v,m in decoded]
+    if numpy is not None:
+        return numpy.array(values,dtype=float).reshape(rows,width),numpy.array(valid,dtype=bool).reshape(rows,width)
+    return values,valid
+
+def stripReply(result,commCode,blanks):
+    """
+    Removes trailing blanks, the echo of commCode and leading blanks from result, 
+    scanning it once and slicing it only at the end.
+    Returns (reply,commCode), commCode being the part of it not echoed.
+    """
+    start,end = 0,len(result)
+    while end and result[end-1] in blanks:
+        end -= 1
+    if result.find(commCode,0,end)>=0:
+        n = min(len(commCode),end)
+        while start<n and commCode[start]==result[start]:
+            start += 1
+        commCode = commCode[start:]
+    while start<end and result[start] in blanks:
+        start += 1
+    return (result[start:end] if start or end<len(result) else result),commCode
+
 class BlackBox(object):
     def __init__(self,size):
         self.size = size
@@ -105,6 +200,707 @@ class BlackBox(object):
         except Exception,e: raise e
         finally: self.lock.release()
 
+class PollScheduler(object):
+    """
+    Keeps the next due time of every read command in a heap, using a monotonic clock.
+    Commands without a fixed period are due once every default period.
+    Next due time is computed from the previous due time (not from the reading time)
+    to avoid drift; periods missed because of a busy line are skipped, the command
+    is due again at once and overdue commands are read in the order they were scheduled.
+    """
+    def __init__(self,period):
+        self.period = period #Default period
+        self.periods = {}
+        self.due = {}
+        self.heap = [] #(due,sequence,key)
+        self.counter = itertools.count()
+        self._reading = None,0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.due)
+
+    def __contains__(self,key):
+        return key in self.due
+
+    def _push(self,key,due):
+        self.due[key] = due
+        heapq.heappush(self.heap,(due,next(self.counter),key))
+
+    def getPeriod(self,key):
+        return self.periods.get(key) or self.period
+
+    def add(self,key):
+        """ Adds a command, due immediately """
+        with self.lock:
+            if key not in self.due:
+                self._push(key,monotonic())
+
+    def setPeriod(self,key,period=None,delay=None):
+        """
+        Sets the period of a command (None for the default period) and, if delay is
+        not None, the remaining time (seconds) until its next reading.
+        Commands not added yet are not scheduled, the period applies once added.
+        """
+        with self.lock:
+            if period: self.periods[key] = period
+            else: self.periods.pop(key,None)
+            if key in self.due and (delay is not None or self.due[key] is None):
+                self._push(key,monotonic()+max(delay or 0,0))
+
+    def remove(self,key):
+        with self.lock:
+            self.periods.pop(key,None)
+            self.due.pop(key,None)
+
+    def next(self):
+        """
+        Returns (key,0) for the next due command, the command is marked as being read until done() is called.
+        If no command is due yet returns (None,seconds to the next one), or (None,None) if empty.
+        """
+        with self.lock:
+            now = monotonic()
+            while self.heap:
+                due,seq,key = self.heap[0]
+                if self.due.get(key)!=due: #Outdated entry
+                    heapq.heappop(self.heap)
+                elif due>now:
+                    return None,due-now
+                else:
+                    heapq.heappop(self.heap)
+                    self.due[key] = None
+                    self._reading = key,due
+                    return key,0
+            return None,None
+
+    def done(self,key):
+        """ Reschedules a command returned by next() """
+        with self.lock:
+            if key not in self.due or self.due[key] is not None:
+                return #Removed or rescheduled while reading
+            last = self._reading[1] if self._reading[0]==key else monotonic()
+            period,now = self.getPeriod(key),monotonic()
+            nxt = last+period
+            if nxt<now: nxt = now #Missed periods are skipped, queued after the other overdue commands
+            self._push(key,nxt)
+
+class CommRecord(object):
+    """
+    Last reading of a read command (see SerialVacuumDevice.getRecord):
+    raw reply, value returned by the command parser (None if not parsed),
+    epoch time of acquisition, latency (seconds) of the transaction,
+    number of retries needed and validity of the reply.
+    
+    Records are replaced, never modified, on each reading; so a reference
+    to a record is always a consistent copy.
+    """
+    __slots__ = ('raw','value','time','latency','retries','valid')
+    
+    def __init__(self,raw='',value=None,time=0,latency=0,retries=0,valid=False):
+        self.raw,self.value,self.time = raw,value,time
+        self.latency,self.retries,self.valid = latency,retries,valid
+        
+    def __repr__(self):
+        return 'CommRecord(%r,%r,%s,%2.3f,%d,%s)'%(self.raw,self.value,self.time,self.latency,self.retries,self.valid)
+    
+    def getAge(self,now=None):
+        """ Seconds since the acquisition, None if never read """
+        return ((now or time.time())-self.time) if self.time else None
+
+class CircuitBreaker(object):
+    """
+    Stops communications with a failing command (or device):
+    
+        CLOSED: normal operation, after threshold consecutive failures it opens.
+        OPEN: communications are not allowed until the backoff time expires.
+        HALF_OPEN: a single probe is allowed; if it succeeds the breaker is closed, 
+            if it fails it opens again doubling the backoff (up to maxbackoff).
+    
+    success() and failure() return True if the state changed.
+    """
+    CLOSED,OPEN,HALF_OPEN = 'CLOSED','OPEN','HALF_OPEN'
+    
+    def __init__(self,threshold=3,backoff=1.,maxbackoff=60.):
+        self.threshold,self.minbackoff,self.maxbackoff = threshold,backoff,maxbackoff
+        self.state = self.CLOSED
+        self.failures = 0 #Consecutive failures
+        self.trips = 0 #Times opened from CLOSED
+        self.backoff = backoff
+        self.until = 0
+        
+    def __repr__(self):
+        return 'CircuitBreaker(%s,failures=%d,trips=%d)'%(self.state,self.failures,self.trips)
+        
+    def allow(self):
+        """ Returns True if a communication is allowed, OPEN switches to HALF_OPEN once backoff expires """
+        if self.state==self.OPEN and monotonic()>=self.until:
+            self.state = self.HALF_OPEN
+        return self.state!=self.OPEN
+        
+    def success(self):
+        changed = self.state!=self.CLOSED
+        self.state,self.failures,self.backoff = self.CLOSED,0,self.minbackoff
+        return changed
+        
+    def failure(self):
+        self.failures += 1
+        if self.state==self.HALF_OPEN:
+            self.backoff = min(2*self.backoff,self.maxbackoff)
+        elif self.state==self.CLOSED and self.failures>=self.threshold:
+            self.trips += 1
+            self.backoff = self.minbackoff
+        else:
+            return False
+        self.state,self.until = self.OPEN,monotonic()+self.backoff
+        return True
+
+class LatencyStats(object):
+    """
+    Latency statistics of a command: EWMA and percentiles of the last size samples.
+    timeout is the p99 latency multiplied by a safety factor, within [minimum,maximum];
+    it is maximum until enough samples are collected.
+    The first reply not received within timeout widens it to maximum for the next
+    attempt (see expired), so it can grow again if the command becomes slower;
+    further misses use the learned timeout, so a dead channel keeps failing fast.
+    """
+    def __init__(self,factor,minimum,maximum,size=100,samples=20,alpha=.1):
+        self.factor,self.minimum,self.maximum = factor,minimum,maximum
+        self.size,self.samples,self.alpha = size,samples,alpha
+        self.buffer = array.array('d',[0.])*size
+        self.count = 0
+        self.ewma = 0
+        self.learned = maximum #Timeout from the percentiles
+        self.timeout = maximum
+        self.missed = 0 #Consecutive replies not received
+        
+    def add(self,latency):
+        self.buffer[self.count%self.size] = latency
+        self.count += 1
+        self.ewma = latency if self.count==1 else self.ewma+self.alpha*(latency-self.ewma)
+        if self.count>=self.samples:
+            self.learned = min(max(self.factor*self.percentile(99),self.minimum),self.maximum)
+        self.timeout,self.missed = self.learned,0
+        
+    def expired(self):
+        """ Called when no reply was received within timeout, only once per streak of misses it widens the timeout """
+        self.missed += 1
+        self.timeout = self.maximum if self.missed==1 else self.learned
+        
+    def percentile(self,p):
+        values = sorted(self.buffer[:min(self.count,self.size)])
+        return values[min(len(values)-1,int(len(values)*p/100.))] if values else 0
+
+class Histogram(object):
+    """ Counts of values in fixed buckets, counts[i] are the values <= buckets[i] (last one is +Inf) """
+    BUCKETS = (.001,.002,.005,.01,.02,.05,.1,.2,.5,1.,2.,5.,10.) #Log spaced, seconds
+    
+    def __init__(self,buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets)+1)
+        self.sum = 0.
+        self.count = 0
+        
+    def add(self,value):
+        self.counts[bisect.bisect_left(self.buckets,value)] += 1
+        self.sum += value
+        self.count += 1
+        
+    def cumulative(self):
+        result,total = [],0
+        for c in self.counts:
+            total += c
+            result.append(total)
+        return result
+
+class CommMetrics(object):
+    """
+    Counters of the serial communications of a device: latency histogram, retries and 
+    timeouts of each command, transactions, bytes in/out and duration of the polling cycle.
+    Counters are updated only from the update thread, so no lock is used.
+    """
+    def __init__(self,name):
+        self.name = name
+        self.latency = collections.defaultdict(Histogram)
+        self.retries = collections.defaultdict(int)
+        self.timeouts = collections.defaultdict(int)
+        self.transactions = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.cycle = 0 #Seconds needed to read all commands once
+        self.cycleStart = monotonic()
+        self.cycleKeys = set()
+        self.tps = 0 #Transactions per second (see rate)
+        self._rate = monotonic(),0
+        
+    def transaction(self,key,latency,ok=True):
+        self.transactions += 1
+        self.latency[key].add(latency)
+        if not ok: self.timeouts[key] += 1
+        
+    def read(self,key,keys):
+        """ Updates the cycle duration after reading key, keys are all the read commands """
+        self.cycleKeys.add(key)
+        if len(self.cycleKeys)>=len(keys):
+            now = monotonic()
+            self.cycle,self.cycleStart = now-self.cycleStart,now
+            self.cycleKeys.clear()
+            
+    def rate(self,period=1.):
+        """ Updates and returns transactions per second since the previous update (at least period seconds ago) """
+        now,(last,count) = monotonic(),self._rate
+        if now-last>=period:
+            self.tps,self._rate = (self.transactions-count)/(now-last),(now,self.transactions)
+        return self.tps
+        
+    def to_prometheus(self):
+        """ Returns all counters in Prometheus text format """
+        quote = lambda s: str(s).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n').replace('\r','\\r')
+        dev = 'device="%s"'%quote(self.name)
+        lines = ['# TYPE svd_latency_seconds histogram']
+        for k,h in sorted(self.latency.items()):
+            label = '%s,command="%s"'%(dev,quote(k))
+            for b,c in zip(list(h.buckets)+['+Inf'],h.cumulative()):
+                lines.append('svd_latency_seconds_bucket{%s,le="%s"} %d'%(label,b,c))
+            lines.append('svd_latency_seconds_sum{%s} %f'%(label,h.sum))
+            lines.append('svd_latency_seconds_count{%s} %d'%(label,h.count))
+        for name,counts in (('retries',self.retries),('timeouts',self.timeouts)):
+            lines.append('# TYPE svd_%s_total counter'%name)
+            for k,v in sorted(counts.items()):
+                lines.append('svd_%s_total{%s,command="%s"} %d'%(name,dev,quote(k),v))
+        for name,kind,value in (('transactions_total','counter',self.transactions),
+                ('bytes_in_total','counter',self.bytesIn),('bytes_out_total','counter',self.bytesOut),
+                ('transactions_per_second','gauge',self.rate()),('cycle_seconds','gauge',self.cycle)):
+            lines.append('# TYPE svd_%s %s'%(name,kind))
+            lines.append('svd_%s{%s} %s'%(name,dev,value))
+        return '\n'.join(lines)+'\n'
+        
+    def dump(self,filename):
+        """ Writes to_prometheus() to filename (replaced atomically) """
+        tmp = filename+'.tmp'
+        f = open(tmp,'w')
+        try: f.write(self.to_prometheus())
+        finally: f.close()
+        os.rename(tmp,filename)
+
+class CommHistory(object):
+    """
+    Fixed size history of a read command stored in preallocated numpy arrays
+    (ring buffer); append() does not allocate memory.
+    
+    times is an array of epochs, values a 2D array with a column for each of the
+    channels stored (invalid readings are stored as nan).
+    """
+    def __init__(self,size,columns=(0,)):
+        self.size,self.columns = size,tuple(columns)
+        self.times = numpy.zeros(size)
+        self.values = numpy.empty((size,len(self.columns)))
+        self.values.fill(numpy.nan)
+        self.count = 0 #Samples appended since creation
+        self.lock = threading.Lock()
+        
+    def append(self,t,values=None):
+        """ Stores the columns of values (or nan if None) at time t """
+        with self.lock:
+            i = self.count%self.size
+            self.times[i] = t
+            row = self.values[i]
+            row.fill(numpy.nan)
+            if values is not None:
+                for j,c in enumerate(self.columns):
+                    if c<len(values): row[j] = values[c]
+            self.count += 1
+            
+    def last(self,n=None):
+        """ Returns (times,values) copies of the last n samples (all if None), oldest first """
+        with self.lock:
+            n = min(self.count,self.size,self.count if n is None else n)
+            idx = numpy.arange(self.count-n,self.count)%self.size
+            return self.times[idx],self.values[idx]
+            
+    def window(self,start,end=None):
+        """ Returns (times,values) of the samples acquired between start and end (epochs) """
+        times,values = self.last()
+        first = numpy.searchsorted(times,start,'left')
+        last = numpy.searchsorted(times,end,'right') if end is not None else len(times)
+        return times[first:last],values[first:last]
+
+class WriteRequest(object):
+    """
+    A write command queued in a WriteQueue, it works as a future:
+    wait() returns the response of the serial line (or raises its exception,
+    or a WriteTimeout exception if not done before timeout, by default the
+    timeout of the WriteQueue), latency is the time (seconds) from submission to response.
+    The callback, if any, is called with the request once done.
+    """
+    def __init__(self,key,command,priority=0,callback=None,timeout=None):
+        self.key,self.command,self.priority = key,command,priority
+        self.timeout = timeout #Default timeout of wait()
+        self.callbacks = [callback] if callback else []
+        self.submitted = monotonic()
+        self.latency = None
+        self.result = None
+        self.exception = None
+        self.replaced = [] #Older requests coalesced into this one
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return 'WriteRequest(%s,%s,%s)'%(self.key,self.command,self.priority)
+
+    def done(self):
+        return self._done.isSet()
+
+    def wait(self,timeout=None):
+        if not self._done.wait(self.timeout if timeout is None else timeout):
+            raise Exception,'SVD(%s)_WriteTimeout!'%self.key
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def set_result(self,result=None,exception=None):
+        self.latency = monotonic()-self.submitted
+        self.result,self.exception = result,exception
+        self._done.set()
+        for c in self.callbacks:
+            try: c(self)
+            except: traceback.print_exc()
+        for r in self.replaced:
+            r.set_result(result,exception)
+
+class WriteQueue(object):
+    """
+    Pending write commands, served by priority and then in order of submission.
+
+    With policy='fifo' all requests are executed, with policy='coalesce' a new
+    request replaces a pending one with the same key (the replaced request
+    gets the result of the new one).
+    Requests with priority>=URGENT preempt the reading of commands.
+    timeout is the default timeout of WriteRequest.wait(), cancel() fails 
+    all pending requests (e.g. when the device is stopped).
+
+    Keys are kept accessible like in the old writeList dictionary.
+    """
+    URGENT = 10
+
+    def __init__(self,policy='fifo',timeout=None):
+        self.policy,self.timeout = policy,timeout
+        self.heap = []
+        self.pending = {} #key: last request
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self,key):
+        return key in self.pending
+
+    def __getitem__(self,key):
+        return self.pending[key].command
+
+    def keys(self):
+        with self.lock:
+            return [r.key for p,i,r in sorted(self.heap)]
+
+    def put(self,key,command,priority=0,callback=None):
+        request = WriteRequest(key,command,priority,callback,self.timeout)
+        with self.lock:
+            if self.policy=='coalesce' and key in self.pending:
+                old = self.pending[key]
+                self.heap.remove((-old.priority,old.index,old))
+                heapq.heapify(self.heap)
+                request.replaced.append(old)
+                request.priority = max(priority,old.priority)
+            request.index = next(self.counter)
+            self.pending[key] = request
+            heapq.heappush(self.heap,(-request.priority,request.index,request))
+        return request
+
+    def cancel(self,exception):
+        """ Removes all pending requests and completes them with exception, returns them """
+        with self.lock:
+            requests = [r for p,i,r in sorted(self.heap)]
+            self.heap,self.pending = [],{}
+        for r in requests:
+            r.set_result('',exception)
+        return requests
+
+    def isUrgent(self):
+        heap = self.heap
+        return bool(heap) and -heap[0][0]>=self.URGENT
+
+    def get(self,urgent=False):
+        """ Returns the next request (or None), only if urgent when urgent=True """
+        with self.lock:
+            if not self.heap or urgent and -self.heap[0][0]<self.URGENT:
+                return None
+            request = heapq.heappop(self.heap)[-1]
+            if self.pending.get(request.key) is request:
+                self.pending.pop(request.key)
+            return request
+
+
+class LineMonitor(object):
+    """
+    Keeps the availability of the serial line device out of the communications path.
+    
+    The alive flag is updated by every transaction (report()) and by a background
+    probe (ping+state) done only if no transaction succeeded in the last ttl seconds.
+    While the line is down the probe period doubles from 1s up to maxbackoff.
+    Without the background thread, isAlive() probes synchronously when ttl expires.
+    
+    When a transaction fails on a line that was alive, the next isAlive() probes
+    it immediately, so a transient error does not block the line until the next probe.
+    """
+    def __init__(self,proxy,ttl=10.,maxbackoff=60.):
+        self.dp = proxy
+        self.ttl = ttl
+        self.maxbackoff = maxbackoff
+        self.alive = None #Unknown
+        self.last = 0 #Last successful communication
+        self.lasterror = ''
+        self.retry = 0 #Current backoff
+        self.next = 0 #Time of the next probe while the line is down
+        self.probes = 0
+        self.probing = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+
+    def report(self,ok,error=''):
+        if ok:
+            self.last = monotonic()
+            self.retry = 0
+        else:
+            self.lasterror = error
+            if self.alive: 
+                self.next = monotonic() #Probe it now
+        self.alive = ok
+
+    def probe(self):
+        if not self.probing.acquire(False):
+            return self.alive #Already being probed
+        try:
+            self.probes += 1
+            try:
+                self.dp.ping()
+                self.dp.state()
+                self.report(True)
+            except Exception,e:
+                self.report(False,str(e))
+                self.retry = min(self.maxbackoff,2*self.retry or 1.)
+                self.next = monotonic()+self.retry
+        finally:
+            self.probing.release()
+        return self.alive
+
+    def isAlive(self):
+        now = monotonic()
+        if self.alive is None or (not self.alive and now>=self.next):
+            return self.probe()
+        if now-self.last>self.ttl and not (self.thread and self.thread.isAlive()):
+            return self.probe()
+        return self.alive
+
+    def start(self,name=None):
+        if self.thread and self.thread.isAlive():
+            return
+        self.event.clear()
+        self.thread = threading.Thread(None,self.run,name)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.event.set()
+
+    def run(self):
+        delay = self.ttl
+        while not self.event.wait(delay):
+            idle = monotonic()-self.last
+            if self.alive and idle<self.ttl:
+                delay = self.ttl-idle
+            elif not self.alive and monotonic()<self.next:
+                delay = self.next-monotonic()
+            elif self.probe():
+                delay = self.ttl
+            else:
+                delay = max(.1,self.next-monotonic())
+
+
+class SerialReader(object):
+    """
+    Drains a serial line continuously into a local bounded buffer.
+    
+    :param size: max size of the buffer, oldest bytes are dropped on overflow
+    :param period: pause between reads while a reply is awaited (see get)
+    :param maxperiod: while idle the pause is doubled on each empty read, up to maxperiod
+    
+    get() waits on a condition until new bytes arrive, clear() discards 
+    the bytes received before a new command is sent (unsolicited or late replies).
+    
+    There is a single reader for each serial line (see BusArbiter.getReader), 
+    its buffer is only read by the controller holding the line; it runs
+    while any of its users has started it, reading with the read method of 
+    the oldest user (see start), and the thread ends when the last one stops it.
+    """
+    def __init__(self,size=4096,period=.005,maxperiod=.2):
+        self.size = size
+        self.period = period
+        self.maxperiod = max(period,maxperiod)
+        self.buffer = bytearray()
+        self.condition = threading.Condition()
+        self.received = 0
+        self.discarded = 0
+        self.overflows = 0
+        self.reads = 0
+        self.lasterror = ''
+        self.wakeup = threading.Event()
+        self.waiting = 0 #Threads waiting in get()
+        self.thread = None
+        self.users = collections.OrderedDict() #user: method returning the characters pending in the serial line
+
+    def isAlive(self):
+        return bool(self.thread and self.thread.isAlive())
+
+    def start(self,name=None,user=None,read=None):
+        with self.condition:
+            self.users[user] = read
+            if self.thread is None:
+                self.thread = threading.Thread(None,self.run,name)
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+    def stop(self,user=None):
+        with self.condition:
+            self.users.pop(user,None)
+        self.wakeup.set()
+
+    def run(self):
+        delay = self.period
+        while True:
+            with self.condition:
+                if not self.users:
+                    self.thread = None
+                    return
+                read = self.users.values()[0]
+            self.wakeup.clear()
+            try:
+                self.reads += 1
+                rec = read()
+            except Exception,e:
+                self.lasterror = str(e)
+                self.wakeup.wait(1.)
+                continue
+            if not rec:
+                delay = self.period if self.waiting else min(2*delay,self.maxperiod)
+                if self.wakeup.wait(delay) and self.waiting:
+                    self.wakeup.clear() #Woken by get(), the reply will not be there before a period
+                    self.wakeup.wait(self.period)
+                continue
+            delay = self.period
+            with self.condition:
+                self.buffer.extend(rec)
+                self.received += len(rec)
+                if len(self.buffer)>self.size:
+                    self.overflows += len(self.buffer)-self.size
+                    del self.buffer[:-self.size]
+                self.condition.notifyAll()
+            self.wakeup.wait(delay) #Next chunk of the reply
+
+    def get(self,timeout=None):
+        """ Returns and removes the buffer contents, waiting up to timeout for new bytes """
+        with self.condition:
+            if not self.buffer and timeout:
+                self.waiting += 1
+                self.wakeup.set() #Stops the idle backoff
+                try: self.condition.wait(timeout)
+                finally: self.waiting -= 1
+            data = str(self.buffer)
+            del self.buffer[:]
+            return data
+
+    def clear(self):
+        """ Discards the buffer contents, returns the number of bytes discarded """
+        with self.condition:
+            n = len(self.buffer)
+            self.discarded += n
+            del self.buffer[:]
+            return n
+
+
+class BusArbiter(object):
+    """
+    Grants exclusive transaction slots on a serial line shared by several 
+    controllers (multidrop RS-485/422 lines).
+    
+    Slots are granted in order of request, so all controllers get the same 
+    chance, and a minimum gap (seconds) is kept between the end of a 
+    transaction and the start of the next one.
+    There is a single arbiter for each serial device name, see get_arbiter().
+    """
+    __arbiters = {}
+    __lock = threading.Lock()
+
+    @classmethod
+    def get_arbiter(cls,name,gap=0.):
+        """ Returns the arbiter of the serial device, the biggest gap requested is used """
+        with cls.__lock:
+            arbiter = cls.__arbiters.get(name.lower())
+            if arbiter is None:
+                arbiter = cls.__arbiters[name.lower()] = cls(name,gap)
+            arbiter.gap = max(arbiter.gap,gap)
+            return arbiter
+
+    def __init__(self,name,gap=0.):
+        self.name = name
+        self.gap = gap
+        self.queue = collections.deque() #Pending requests
+        self.condition = threading.Condition()
+        self.owner = None
+        self.acquired = 0
+        self.released = 0
+        self.started = monotonic()
+        self.busy = {} #owner: seconds using the line
+        self.slots = {} #owner: transactions
+        self.reader = None #SerialReader shared by all controllers of the line
+
+    def getReader(self,size,period=.005):
+        """ Returns the SerialReader of the line, created with the size and period of the first controller """
+        with self.condition:
+            if self.reader is None:
+                self.reader = SerialReader(size,period)
+            return self.reader
+
+    def acquire(self,owner,timeout=None):
+        """ Waits until the line is free for owner, raises an Exception on timeout """
+        token = [owner]
+        with self.condition:
+            self.queue.append(token)
+            end = timeout and monotonic()+timeout
+            while self.queue[0] is not token or self.owner is not None:
+                if end and monotonic()>=end:
+                    self.queue.remove(token)
+                    self.condition.notifyAll()
+                    raise Exception('BusArbiter(%s): %s timeout waiting for line'%(self.name,owner))
+                self.condition.wait(end and end-monotonic())
+            self.queue.popleft()
+            self.owner = owner
+            wait = self.released+self.gap-monotonic()
+        if wait>0:
+            time.sleep(wait)
+        self.acquired = monotonic()
+
+    def release(self):
+        with self.condition:
+            self.released = monotonic()
+            owner,self.owner = self.owner,None
+            self.busy[owner] = self.busy.get(owner,0)+self.released-self.acquired
+            self.slots[owner] = self.slots.get(owner,0)+1
+            self.condition.notifyAll()
+
+    def getUsage(self):
+        """ Returns the fraction of time that each controller used the line """
+        elapsed = monotonic()-self.started
+        return dict((k,v/elapsed) for k,v in self.busy.items())
+
 
 # ---------------------------------------------------------------
 #    The SerialVacuumDevice Class
@@ -127,21 +923,67 @@ class SerialVacuumDevice(TangoDev,Logger):
         :param retries: number of times that read commands are retried 
 			if no answer is received
         :param log: logging level
+        :param ttl: seconds the serial line is considered alive after 
+            a successful communication, then it is probed again
+        :param lean: if True, PySerial port is kept open while the update thread 
+            runs and buffers are flushed only after a timeout or framing error
+        :param reader: if >0, size of the buffer of a SerialReader thread that 
+            drains the serial device continuously (it implies lean=True),
+            shared by all controllers of the same serial line
+        :param readerperiod: pause (seconds) between reads of the SerialReader while a reply
+            is awaited, while idle it is doubled on each empty read (see SerialReader)
+        :param engine: 'thread' to run updateHW in its own thread, 'loop' to 
+            share a single UpdateEngine thread with all devices of the server, 'pool'
+            to share a pool of UpdateEngine workers (one for each serial line)
+        :param gap: minimum time (seconds) between two transactions on the 
+            serial line, shared with other controllers in the same line (see BusArbiter)
+        :param blackbox: number of communications kept in the BlackBox (0 to disable)
+        :param blackboxfile: if set, the BlackBox is a memory-mapped file that survives
+            crashes of the server (see BlackBoxFile)
+        :param learn: if >0, the timeout of each command is its p99 latency multiplied 
+            by learn, between minwait and wait (see LatencyStats); 0 to always wait
+        :param breaker: if >0, consecutive failures that open the CircuitBreaker of a 
+            command, then it is probed every backoff seconds (doubled up to maxbackoff); 
+            if all commands fail the whole device is probed at that rate
+        :param metrics: file where CommMetrics are written in Prometheus text 
+            format every metricsperiod seconds
+        :param proxy: DeviceProxy used instead of connecting to tangoDevice 
+            (e.g. a SerialEmulator to test without hardware)
+        :param record: file where all serialComm transactions are recorded (see TrafficRecorder),
+            it can be replayed with a TrafficReplay proxy
+        :param writepolicy: policy of the WriteQueue; 'fifo' sends all write commands, 
+            'coalesce' replaces a pending write command by a newer one with the same key
     """
-    def __init__(self,tangoDevice,period=.1,threadname=None,wait=2, retries=3,log='DEBUG',blackbox=0):
+    ADAPTIVE_FACTOR = 1.5 #Increase of adaptive periods on each stable reading
+    
+    def __init__(self,tangoDevice,period=.1,threadname=None,wait=2, retries=3,log='DEBUG',blackbox=0,ttl=10.,lean=False,reader=0,engine='thread',gap=0.,blackboxfile='',learn=0,minwait=.02,breaker=0,backoff=1.,maxbackoff=60.,metrics='',metricsperiod=10.,proxy=None,record='',writepolicy='fifo',readerperiod=.005):
         print "In SerialVacuumDevice::init_device(",tangoDevice,")"
 
         self.init = False
-        self.trace = False
+        self.trace = False #Set by serialComm for the sampled transactions (see setTrace)
+        self.traceRate = 0
+        self.traceCounts = {} #Transactions of each command since setTrace
+        self.debugging = True #Debug level enabled, checked once per cycle (see checkDebug)
+        self.cycleSteps = 0
                 
         self.readList = fandango.SortedDict() #Dictionary
-        self.writeList = fandango.SortedDict() #Dictionary
+        self.records = {} #Last CommRecord of each read command
+        self.valid_epochs = {} #Time of the last valid reply of each read command
+        self.histories = {} #CommHistory of read commands (see setHistory)
+        self.adaptive = {} #command: [min period,max period,threshold,last values] (see setAdaptivePeriod)
+        self.alarms = set() #Commands polled at minimum period (see setAlarm)
+        self.parsers = {} #Methods to parse the replies of read commands (see addComm)
         self.pollingList = fandango.SortedDict()
         self.PostCommand = []        
         self.args = (0,0) #Tuple
         self.kwargs = {'nada':0} #Dictionary
 
         self.blankChars = set([ '\n', '\r', ' ', '>' ])
+        ## Reply framing (see setFraming), if not set the end of a reply
+        # is detected by silence in the serial line
+        self.terminator = None
+        self.replyLength = 0
+        self.framePoll = .01
         ## period (seconds): It will be divided between the number 
         # of pollings to determine the pause between readings
         self.period = max(period,.020)
@@ -149,8 +991,24 @@ class SerialVacuumDevice(TangoDev,Logger):
         # device server will wait for an answer from the serial line.        
         self.waitTime = max(wait,.020)
         self.retries = retries
+        ## Pending write commands, wait() gives up after the worst case of a read and a write
+        self.writeList = WriteQueue(writepolicy,timeout=(self.retries+2)*self.waitTime)
+        self.learn = learn
+        self.minWait = min(minwait,self.waitTime)
+        self.latencies = {} #LatencyStats of each command (if learn>0)
+        self.breakers = {} #CircuitBreaker of each read command (if breaker>0)
+        self.breaker = CircuitBreaker(1,backoff,maxbackoff) if breaker else None #Device breaker
+        self.breakerConfig = breaker,backoff,maxbackoff
+        self.metricsFile,self.metricsPeriod,self.metricsDumped = metrics,metricsperiod,monotonic()
+        self.lastdata = None #Time of the last data received in readComm
+        self.scheduler = PollScheduler(self.period) #Next due time of each read command
         
         self.lasttime = 0 #Used to store the time of the last communication
+        self.lean = lean or bool(reader)
+        self.opened = False #PySerial port kept open in lean mode
+        self.flushNeeded = True
+        self.dpcalls = 0 #Remote calls to the serial device
+        self.lastdpcalls = 0 #Remote calls done in the last transaction
         self.lastrecv = ''
         self.lastsend = ''
         self.lasterror = ''
@@ -167,17 +1025,27 @@ class SerialVacuumDevice(TangoDev,Logger):
         self.threadname = threadname    
         self.lock=threading.RLock();
         self.event=threading.Event();
+        self.wakeup=threading.Event(); #Set when a write command is queued
         self.threadname=threadname
         self.updateThread = None
+        self.engine = UpdateEngine.get_instance(engine=='pool') if engine in ('loop','pool') else None
         
-        TangoDev.__init__(self,tangoDevice)
+        if proxy is not None:
+            self.tangoDevice,self.dp = tangoDevice,proxy
+        else:
+            TangoDev.__init__(self,tangoDevice)
+        self.monitor = LineMonitor(getattr(self,'dp',None),ttl) #Availability of the serial line
+        self.arbiter = BusArbiter.get_arbiter(tangoDevice,gap) #Shared with other controllers in the line
+        self.reader = self.arbiter.getReader(reader,readerperiod) if reader else None
+        self.metrics = CommMetrics(tangoDevice)
+        self.recorder = TrafficRecorder(record) if record else None
         self.call__init__(Logger,'SVD('+tangoDevice+')',format='%(levelname)-8s %(asctime)s %(name)s: %(message)s')
         try: self.setLogLevel(log)
         except: print('Unable to set SerialVacuumDevice.LogLevel')
         self.errors = 0
         
         if blackbox: 
-            self.blackbox = BlackBox(blackbox)
+            self.blackbox = BlackBoxFile(blackboxfile,blackbox) if blackboxfile else BlackBox(blackbox)
             self.dp.command_inout = self.blackbox.decorator(self.dp.command_inout)
             self.serialComm = self.blackbox.decorator(self.serialComm)
             print 'SerialVacuumDevice.BlackBox(%d) created'%self.blackbox.size
@@ -216,10 +1084,55 @@ class SerialVacuumDevice(TangoDev,Logger):
                 self.serialClass = None
         return self.serialClass
 
+    def setFraming(self,terminator=None,length=0,poll=None):
+        """
+        Declares how a complete reply looks like for this controller,
+        readComm will return as soon as it is in the buffer:
+
+        :param terminator: end of reply; a string like '\\r', '\\r\\n' or '>' or a tuple of them
+        :param length: minimum number of characters of a complete reply (echo excluded)
+        :param poll: period (seconds) used to check the buffer while waiting
+
+        ACK/NACK replies of PostCommand sequences are always recognized.
+        """
+        if terminator and not isinstance(terminator,basestring):
+            terminator = tuple(terminator)
+        self.terminator = terminator or None
+        self.replyLength = length or 0
+        if poll: self.framePoll = max(poll,.001)
+
+    def isReplyComplete(self,commCode,reply,expect=None):
+        """
+        Returns True if reply (echo included) already contains a full answer to commCode
+        :param expect: list of accepted replies (e.g. the ACK,NACK of a PostCommand)
+        """
+        blanks,n = self.blankChars,len(reply)
+        echo = commCode.rstrip('\r\n')
+        start = len(echo) if echo and reply.startswith(echo) else 0
+        while start<n and reply[start] in blanks:
+            start += 1
+        if start==n:
+            return False
+        if expect:
+            end = n
+            while reply[end-1] in blanks:
+                end -= 1
+            for e in expect:
+                if len(e)==end-start and reply.startswith(e,start):
+                    return True
+        if self.terminator:
+            return reply.endswith(self.terminator,start)
+        return bool(self.replyLength) and n-start>=self.replyLength
+
     def getReport(self):
         status=''
         if len(self.lastrecv):
             status = status+'Comms at '+time.strftime('%H:%M:%S',time.localtime(self.lasttime))+':\n\t"'+self.lastsend+'" -> "'+self.lastrecv+'"\n'
+        if len(self.arbiter.busy)>1:
+            status = status+'Bus %s shared by %d controllers, usage: %s\n'%(self.arbiter.name,len(self.arbiter.busy),
+                ', '.join('%s=%2.1f%%'%(k,100*v) for k,v in sorted(self.arbiter.getUsage().items())))
+        if self.lastdpcalls:
+            status = status+'Remote calls: %d in last command, %d total.\n'%(self.lastdpcalls,self.dpcalls)
         if self.errors:
             status = status+str(self.errors)+' CommsErrors.\n'
         if self.error_rate:
@@ -228,16 +1141,33 @@ class SerialVacuumDevice(TangoDev,Logger):
             status = status+'LastError: %s\n%s\n' % (time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(self.lasterror_epoch)),self.lasterror)
         return status    
         
-    def addComm(self,_key,_val=None):
+    def addComm(self,_key,_val=None,priority=0,callback=None,parser=None):
+        """
+        Adds _key to the list of read commands or, if _val is given, queues _val as write command.
+        For write commands a WriteRequest is returned, its wait(timeout) method returns the response
+        (an exception is raised if the command fails or is not sent before timeout).
+        
+        :param parser: method applied to each reply of a read command, 
+            its result is stored as value of the CommRecord (e.g. decodeChannels)
+        :param priority: write commands with higher priority are sent first; WriteQueue.URGENT 
+            or higher will be sent before continuing with read commands.
+        :param callback: method called with the WriteRequest once the command is sent
+        """
+        request = None
         self.lock.acquire()
         if _val is None:
             self.info('SerialVacuumDevice::addComm: Adding '+_key+' to the list of Read Commands')
             self.readList[_key]=_val
+            if parser is not None: self.parsers[_key]=parser
+            self.scheduler.add(_key)
             self.comms+=1
+            self.notify()
         else:
             self.info( 'SerialVacuumDevice::addComm: Adding '+_key+','+_val+' to the list of Write Commands: %s'%self.writeList.keys())
-            self.writeList[_key]=_val
+            request = self.writeList.put(_key,_val,priority,callback)
+            self.notify()
         self.lock.release()
+        return request
 
     def getComm(self,_key):
         self.lock.acquire()
@@ -249,6 +1179,53 @@ class SerialVacuumDevice(TangoDev,Logger):
         else:
             return result
         
+    def getRecord(self,_key):
+        """ Returns the last CommRecord of a read command, an empty record if not read yet """
+        return self.records.get(_key) or CommRecord()
+        
+    def getSnapshot(self,keys=None):
+        """ Returns a dictionary {command:CommRecord} with the last reading of all (or keys) read commands """
+        self.lock.acquire()
+        try:
+            if keys is None: return dict(self.records)
+            return dict((k,self.records[k]) for k in keys if k in self.records)
+        finally:
+            self.lock.release()
+            
+    def getAge(self,_key):
+        """ Seconds since the last valid reading of a command, None if never read """
+        return self.valid_epochs.get(_key) and time.time()-self.valid_epochs[_key]
+        
+    def setHistory(self,_key,size,columns=(0,)):
+        """
+        Keeps the last size readings of a read command (size=0 disables it).
+        Replies are decoded with decodeChannels, columns are the indexes of the 
+        channels to store. It requires numpy.
+        """
+        self.lock.acquire()
+        try:
+            if not size:
+                self.histories.pop(_key,None)
+            elif numpy is None:
+                self.warning('setHistory(%s): numpy not available, history disabled'%_key)
+            else:
+                self.histories[_key] = CommHistory(size,columns)
+        finally:
+            self.lock.release()
+            
+    def getHistory(self,_key,last=None,start=None,end=None):
+        """
+        Returns (times,values) arrays with the history of a read command:
+        the last N readings or, if start is given, the readings between start and end (epochs).
+        Values has a column for each channel (see setHistory); for a spectrum attribute use values[:,i].
+        """
+        history = self.histories.get(_key)
+        if history is None:
+            raise Exception('SVD(%s)_HistoryNotEnabled!'%_key)
+        if start is not None:
+            return history.window(start,end)
+        return history.last(last)
+        
     def setPolledComm(self,_key,_period,start_time=0.):
         """ srubio 9.2007: This command has been added to allow 
 			management of the hardware commandspolling through Tango 
@@ -259,10 +1236,135 @@ class SerialVacuumDevice(TangoDev,Logger):
         if _period is None or not _period or _period<0:
             if _key in self.pollingList.keys():
                 self.pollingList.pop(_key)
+            self.scheduler.setPeriod(_key,None)
         else:
             self.pollingList[_key]=_period,start_time #period,lastread
+            self.scheduler.setPeriod(_key,_period,delay=start_time+_period-time.time())
+        self.notify()
         return
         
+    def setAdaptivePeriod(self,_key,minimum=None,maximum=None,threshold=.05):
+        """
+        The polling period of _key will move between minimum and maximum (seconds):
+        it is set to minimum if the relative change of any channel exceeds threshold
+        or the command is in alarm (see setAlarm); on each stable reading it is increased 
+        by ADAPTIVE_FACTOR. Invalid readings are not changes, they also increase the period
+        (or keep it in alarm), so a dead channel is not polled faster; retrying it is left 
+        to the breakers.
+        minimum=None disables it, restoring the period set by setPolledComm.
+        """
+        if not minimum:
+            self.adaptive.pop(_key,None)
+            period = self.pollingList[_key][0] if _key in self.pollingList else None
+            self.scheduler.setPeriod(_key,period)
+            return
+        if not _key in self.readList.keys():
+            self.addComm(_key)
+        self.adaptive[_key] = [minimum,max(minimum,maximum or minimum),threshold,None]
+        self.scheduler.setPeriod(_key,minimum)
+        self.notify()
+        
+    def adaptPeriod(self,_key,values):
+        """ Updates the period of an adaptive command after a reading, values is None for invalid readings """
+        minimum,maximum,threshold,last = self.adaptive[_key]
+        period = self.scheduler.getPeriod(_key)
+        if values is None: #Last valid values are kept to compare with the next valid reading
+            new = period if _key in self.alarms else min(maximum,period*self.ADAPTIVE_FACTOR)
+        else:
+            self.adaptive[_key][3] = values
+            changed = last is None or _key in self.alarms or len(values)!=len(last)
+            for v,l in (zip(values,last) if not changed else []):
+                if (v!=v)!=(l!=l) or abs(v-l)>threshold*max(abs(v),abs(l)): #nan or relative change
+                    changed = True
+                    break
+            new = minimum if changed else min(maximum,period*self.ADAPTIVE_FACTOR)
+        if new!=period:
+            if self.trace: self.debug('adaptPeriod(%s): %s -> %s'%(_key,period,new))
+            self.scheduler.setPeriod(_key,new,delay=new if new<period else None)
+            
+    def setAlarm(self,_key,alarm=True):
+        """ Commands in alarm are polled at the minimum adaptive period """
+        if alarm:
+            self.alarms.add(_key)
+            if _key in self.adaptive:
+                self.scheduler.setPeriod(_key,self.adaptive[_key][0],delay=0)
+                self.notify()
+        else:
+            self.alarms.discard(_key)
+            
+    def updateBreakers(self,_key,breaker,ok):
+        """ Updates command and device breakers after a reading, logging only state changes """
+        if ok:
+            if breaker.success(): self.warning('updateHW(%s): communication restored, breaker closed'%_key)
+            if self.breaker.success(): self.warning('updateHW(): device communication restored, breaker closed')
+            return
+        if breaker.failure(): 
+            self.warning('updateHW(%s): breaker %s after %d failures, next probe in %s s'%(_key,breaker.state,breaker.failures,breaker.backoff))
+        keys = self.readList.keys()
+        if self.breaker.state!=CircuitBreaker.CLOSED or all(k in self.breakers and self.breakers[k].state!=CircuitBreaker.CLOSED for k in keys):
+            if self.breaker.failure():
+                self.warning('updateHW(): all commands failing, device breaker %s, next probe in %s s'%(self.breaker.state,self.breaker.backoff))
+        
+    def getBreakers(self):
+        """ Returns a dictionary {command:(state,trips,failures)}, the device breaker is returned for key '' """
+        result = dict((k,(v.state,v.trips,v.failures)) for k,v in self.breakers.items())
+        if self.breaker is not None:
+            result[''] = (self.breaker.state,self.breaker.trips,self.breaker.failures)
+        return result
+        
+    def getMetrics(self):
+        """ Returns a dictionary with the global counters of CommMetrics """
+        m = self.metrics
+        return {'transactions':m.transactions,'tps':m.rate(),'bytes_in':m.bytesIn,'bytes_out':m.bytesOut,
+            'cycle':m.cycle,'retries':sum(m.retries.values()),'timeouts':sum(m.timeouts.values())}
+    
+    def getHistogram(self,_key):
+        """ Returns the latency histogram of a command as a list of counts, for spectrum attributes (see Histogram.BUCKETS) """
+        return list(self.metrics.latency[_key].counts) if _key in self.metrics.latency else []
+        
+    def getTimeout(self,commCode):
+        """ Time to wait for the reply to commCode, learned from its latency if learn>0 """
+        stats = self.latencies.get(commCode)
+        return stats.timeout if stats is not None else self.waitTime
+        
+    def getTimeouts(self):
+        """ Returns a dictionary {command:(timeout,ewma,p99,samples)} with the learned latencies """
+        return dict((k,(v.timeout,v.ewma,v.percentile(99),v.count)) for k,v in self.latencies.items())
+        
+    def setTrace(self,rate=1):
+        """ 
+        Traces the serial transactions at runtime: 0 disables it, 1 traces all 
+        transactions and N one of every N transactions of each command 
+        """
+        self.traceRate = max(0,int(rate))
+        self.traceCounts.clear()
+        self.trace = False
+        
+    def getTrace(self):
+        return self.traceRate
+        
+    def setLogLevel(self,level):
+        result = Logger.setLogLevel(self,level)
+        self.checkDebug()
+        return result
+        
+    def checkDebug(self):
+        """ Updates self.debugging, hot loops check it instead of formatting debug messages that won't be shown """
+        try: self.debugging = bool(self.checkLogLevel('DEBUG'))
+        except: self.debugging = True
+        return self.debugging
+        
+    def getPeriods(self):
+        """ Returns a dictionary with the effective polling period of each read command """
+        return dict((k,self.scheduler.getPeriod(k)) for k in self.readList.keys())
+        
+    def getEngineUsage(self):
+        """ Returns a dictionary with the UpdateEngine report (queue depth) and the busy and cpu seconds spent updating this device """
+        if not self.engine:
+            return {}
+        busy,cpu = self.engine.getUsage(self)
+        return {'engine':self.engine.getReport(),'busy':'%2.3f'%busy,'cpu':'%2.3f'%cpu if cpu is not None else 'n/a'}
+        
     def setPolledNext(self,_key):
         if _key in self.pollingList:
             _period = self.pollingList[_key][0]
@@ -271,7 +1373,20 @@ class SerialVacuumDevice(TangoDev,Logger):
             self.warning('.setPolledNext(%s): key not in polled list!\n\t%s'
                            %(_key,self.pollingList.keys()))
         
+    def notify(self):
+        """ Interrupts the wait between communications (see waitComm) """
+        self.wakeup.set()
+        if self.engine: self.engine.notify(self)
+
     def start(self):
+        if self.engine:
+            self.info('SerialVacuumDevice.start(%s)'%self.engine.name)
+            self.event.clear()
+            self.wakeup.clear()
+            self.startUpdate()
+            if self.reader: self.reader.start(self.arbiter.name+'.reader',self,self.drainSerial) #Before the first transaction
+            self.engine.add(self)
+            return
         if self.updateThread:
             if self.updateThread.isAlive():
                 self.warning('SerialVacuumDevice.start() not allowed, Thread is still Working!!!')
@@ -279,13 +1394,22 @@ class SerialVacuumDevice(TangoDev,Logger):
             else: del self.updateThread
         self.info('SerialVacuumDevice.start()')
         self.event.clear()
+        self.wakeup.clear()
+        if self.reader: self.reader.start(self.arbiter.name+'.reader',self,self.drainSerial) #Before the first transaction
         self.updateThread = threading.Thread(None,self.updateHW,self.threadname)
         self.updateThread.setDaemon(True)
         self.updateThread.start()
+        self.monitor.start(self.threadname and self.threadname+'.monitor')
         
     def stop(self):
         print 'In SerialVacuumDevice.stop() ...'
         self.event.set()
+        self.wakeup.set()
+        self.monitor.stop()
+        if self.reader: self.reader.stop(self)
+        if self.engine:
+            self.engine.remove(self)
+            return
         self.updateThread.join(self.waitTime)
         if self.updateThread.isAlive():
             self.warning( 'Thread '+self.updateThread.getName()+' doesn''t Stop!')
@@ -293,97 +1417,188 @@ class SerialVacuumDevice(TangoDev,Logger):
             self.warning( 'Thread '+self.updateThread.getName()+' Stop')
         return
         
+    def waitComm(self,timeout,urgent=True):
+        """
+        Waits timeout seconds between communications; the wait is interrupted
+        by stop(), by urgent write commands or, if urgent=False, by any new command.
+        """
+        end = monotonic()+timeout
+        while not self.event.isSet():
+            if self.writeList.isUrgent():
+                return
+            remaining = end-monotonic()
+            if remaining<=0:
+                return
+            if self.wakeup.wait(remaining) and not urgent:
+                return
+            self.wakeup.clear()
+
+    def processWrites(self,pause,urgent=False,limit=0):
+        """ 
+        Sends the pending write commands (only the urgent ones if urgent=True),
+        waiting pause between them. Returns the number of commands sent.
+        :param limit: max number of commands to send (0 for all)
+        """
+        count = 0
+        while not self.event.isSet() and not (limit and count>=limit):
+            request = self.writeList.get(urgent)
+            if request is None: break
+            if count: self.waitComm(pause)
+            if self.trace: self.info( 'There\'s %d'%(len(self.writeList)+1) +' write commands pending: %s'%str([request.key]+self.writeList.keys()))
+            try:
+                result=self.serialComm(request.command,False,self.PostCommand)
+                request.set_result(result)
+            except Exception,e:
+                self.error('updateHW(%s): Serial Line write access failed with exception!: \n%s' % (request.key,traceback.format_exc()))
+                self.add_new_error('%s:SerialWriteException:%s'%(request.key,str(e)))
+                request.set_result('',e)
+            count += 1
+        return count
+
     def updateHW(self):#,args,kwargs):
         """ srubio 9.2007: this method has been modified to manage devices which polling frequency has been configured from Tango
             The rest of devices will be polled at the frequency set by the 'Refresh' property ... it will be always the minimum pause between connections
+            Read commands are executed in order of due time (see PollScheduler), 
+            the thread sleeps until the next command is due.
         """
-        trace = True
-        self.Alive=True
-        
+        self.startUpdate()
         while not self.event.isSet():
-            #if self.trace: print 'Updating Hardware Values'
-            pause = self.period/(len(self.readList) or 1.)
-            self.debug('Start of cycle, period = %s s, pause = %s s/comm'%(self.period,pause))
-                    
-            #This check is needed to avoid last commands in the list to be removed by continuous start/stop
-            keys = sorted(self.readList.keys())
-            self.debug('readList.keys(): %s'%keys)
-            if self._last_read and self._last_read<keys[-1]:
-                keys = [k for k in keys if k>self._last_read]
-                if self.trace: self.info('Thread stopped at %s before finishing the cycle!, continues with %s'%(self._last_read,keys))
-                    
-            for rd in keys:
-                self.debug('In updateHW(%s), checking write commands'%rd)
-                #First the write commands
-                #-----------------------------------------------------------------------
-                for wr in self.writeList.keys():
-                    if self.event.isSet(): break
-                    if self.trace: self.info( 'There\'s %d'%len(self.writeList) +' write commands pending: %s'%str(self.writeList.keys()))
-                    try:
-                        result=self.serialComm(self.writeList[wr],False,self.PostCommand)
-                    except Exception,e:
-                        self.error('updateHW(%s): Serial Line write access failed with exception!: \n%s' % (wr,traceback.format_exc()))
-                        self.add_new_error('%s:SerialWriteException:%s'%(rd,str(e)))
-                        result = ""
-                    finally:
-                        self.lock.acquire()
-                        self.writeList.pop(wr)
-                        self.lock.release()             
-                        self.event.wait(pause)
-                if self.event.isSet(): break
-                #End of the write part
-                
-                #Then the reading commands
-                #-----------------------------------------------------------------------
-                self._last_read = rd
-                if rd in self.pollingList.keys(): #When a period is specified for a Command this is readed only at this certain period, by default all the commands are readed continuously
-                    nxt = self.pollingList[rd][1]+self.pollingList[rd][0]
-                    now = time.time()
-                    if now<nxt: #If the time for the command to be read has not been reached the bucle jumps to the next command
-                        self.event.wait(pause/4.)
-                        #if self.trace: self.debug('Command %s has %s polling, continue ...'%(rd,self.pollingList[rd][0]*1000))
-                        continue 
-                    else: #If the time has been reached the list is updated and we proceed to read the serial port
-                        self.pollingList[rd]=self.pollingList[rd][0],now #period,last_read
-
-                self.debug('In updateHW(%s)'%rd)
-                for i in range(self.retries+1):
-                    # Only for read commands, several retries are executed
-                    # Write commands should have its own verification for that!
-                    result = ''
-                    if i: (self.errors<15 and self.warning or self.debug)( 'updateHW(%s): Communication failed, retrying %d/%d'%(rd,i,self.retries))
-                    try:
-                        result=self.serialComm(rd,True,self.PostCommand)
-                        if len(result): 
-                            #self.errors = 0
-                            break
-                        elif self.lastsend: 
-                            raise Exception,'SVD(%s)_NothingReceived!'%rd.strip()
-                        else:
-                            raise Exception,self.lasterror
-                    except Exception,e:
-                        if 1: #(time.time()-self.lasterror_epoch)>10:
-                            self.error('updateHW(%s): Serial Line read access failed with exception!: %s'%(rd,'SVD' in str(e) and str(e) or traceback.format_exc()))
-                        self.add_new_error('%s:SerialReadException:%s'%(rd,str(e)))
-                        self.event.wait(pause/2.)
-
-                #-----------------------------------------------------------------------
-                self.lock.acquire()
-                self.readList[rd]=result
-                if result: self.debug('%s = "%s"' % (rd,result))
-                self.lock.release()
-                if self.trace: self.debug('Waiting %f before next communication'%pause)
-                self.event.wait(pause)
-                if self.event.isSet():
-                    self.warning( 'WARNING: Something enabled SerialVacuumDevice.Event before Wait ends!')
-                pass
-            if not self.init: self.info('\n===================> First Serial Line update cycle completed\n')
-            self.init = True
-            self.debug('End of reading cycle, last read was %s'%self._last_read)
-            self.event.wait(pause/3.)
+            try:
+                wait,urgent = self.updateStep()
+            except Exception,e: #The thread must not die
+                self.error('updateHW(): updateStep failed!: %s'%traceback.format_exc())
+                self.add_new_error('updateHW:%s'%e)
+                wait,urgent = self.period,True
+            self.waitComm(wait,urgent)
+        self.stopUpdate()
+
+    def startUpdate(self):
+        self.Alive=True
+        self.unread = set(self.readList.keys()) #Commands not read yet since start()
+
+    def stopUpdate(self):
+        pending = self.writeList.cancel(Exception('SVD(%s)_DeviceStopped!'%self.tangoDevice))
+        if pending: self.warning('stopUpdate(): %d write commands cancelled: %s'%(len(pending),[r.key for r in pending]))
+        self.closePort()
         self.info('Out of updateHW()')
         self.Alive=False
-        return
+
+    def updateStep(self):
+        """
+        Sends the next pending write command or, if none, the next due read command.
+        It is called in a loop by updateHW or by an UpdateEngine.
+        
+        Returns a tuple (seconds to wait before the next step, urgent); if urgent 
+        is True only urgent write commands should interrupt the wait (see waitComm).
+        """
+        pause = self.period/(len(self.readList) or 1.)
+        self.scheduler.period = self.period
+        if len(self.scheduler)!=len(self.readList):
+            for k in self.readList.keys(): self.scheduler.add(k)
+        
+        #First the write commands
+        #-----------------------------------------------------------------------
+        self.wakeup.clear()
+        if self.processWrites(pause,limit=1):
+            return pause,True
+        
+        #Then the reading commands
+        #-----------------------------------------------------------------------
+        rd,wait = self.scheduler.next()
+        if rd is None:
+            #Nothing due yet, any new command will interrupt the wait
+            return (pause if wait is None else wait),False
+        
+        breaker = None
+        if self.breaker is not None:
+            if rd not in self.breakers:
+                self.breakers[rd] = CircuitBreaker(*self.breakerConfig)
+            breaker = self.breakers[rd]
+            if not (self.breaker.allow() and breaker.allow()):
+                self.scheduler.done(rd) #Skipped until next backoff probe
+                if not self.init: self.unread.discard(rd)
+                return 0,True
+        
+        self._last_read = rd
+        if rd in self.pollingList.keys(): #period,last_read
+            self.pollingList[rd]=self.pollingList[rd][0],time.time()
+
+        if self.cycleSteps<=0:
+            self.cycleSteps = len(self.readList)
+            self.checkDebug()
+        self.cycleSteps -= 1
+        if self.debugging: self.debug('In updateHW(%s)'%rd)
+        latency = 0
+        #Probes of open breakers are not retried
+        closed = breaker is None or (breaker.state==self.breaker.state==CircuitBreaker.CLOSED)
+        try:
+            for i in range(self.retries+1 if closed else 1):
+                # Only for read commands, several retries are executed
+                # Write commands should have its own verification for that!
+                result = ''
+                if i and self.processWrites(pause,urgent=True): 
+                    self.waitComm(pause)
+                if i and (self.errors<15 or self.debugging): 
+                    (self.errors<15 and self.warning or self.debug)( 'updateHW(%s): Communication failed, retrying %d/%d'%(rd,i,self.retries))
+                if i:
+                    self.metrics.retries[rd] += 1
+                try:
+                    t0 = monotonic()
+                    result=self.serialComm(rd,True,self.PostCommand)
+                    latency = monotonic()-t0
+                    if len(result): 
+                        #self.errors = 0
+                        break
+                    elif self.lastsend: 
+                        raise Exception,'SVD(%s)_NothingReceived!'%rd.strip()
+                    else:
+                        raise Exception,self.lasterror
+                except Exception,e:
+                    if closed or self.debugging:
+                        (self.error if closed else self.debug)('updateHW(%s): Serial Line read access failed with exception!: %s'%(rd,'SVD' in str(e) and str(e) or traceback.format_exc()))
+                    self.add_new_error('%s:SerialReadException:%s'%(rd,str(e)))
+                    self.waitComm(pause/2.)
+        finally:
+            self.scheduler.done(rd)
+        if breaker is not None: 
+            self.updateBreakers(rd,breaker,bool(result))
+
+        #-----------------------------------------------------------------------
+        value,parser = None,self.parsers.get(rd)
+        if result and parser:
+            try: value = parser(result)
+            except Exception,e: self.warning('updateHW(%s): unable to parse "%s": %s'%(rd,result,e))
+        now,valid = time.time(),bool(result) and (parser is None or value is not None)
+        self.lock.acquire()
+        self.readList[rd]=result
+        self.records[rd]=CommRecord(result,value,now,latency,i,valid)
+        if valid: self.valid_epochs[rd]=now
+        if result and self.debugging: self.debug('%s = "%s"' % (rd,result))
+        self.lock.release()
+        history,values = self.histories.get(rd),None
+        try:
+            if valid and (history is not None or rd in self.adaptive):
+                values = decodeChannels(result)[0]
+            if history is not None: 
+                history.append(now,values)
+            if rd in self.adaptive:
+                self.adaptPeriod(rd,values)
+        except Exception,e:
+            self.warning('updateHW(%s): unable to decode "%s": %s'%(rd,result,e))
+        self.metrics.read(rd,self.readList)
+        if self.metricsFile and monotonic()>self.metricsDumped+self.metricsPeriod:
+            self.metricsDumped = monotonic()
+            try: self.metrics.dump(self.metricsFile)
+            except Exception,e: self.warning('Unable to write metrics to %s: %s'%(self.metricsFile,e))
+        
+        if not self.init:
+            self.unread.discard(rd)
+            if not self.unread:
+                self.info('\n===================> First Serial Line update cycle completed\n')
+                self.init = True
+            
+        if self.trace: self.debug('Waiting %f before next communication'%pause)
+        return pause,True
                 
     ## This command is being overriden at INIT!!!
     #def sendComm(self, commCode, READ=True):
@@ -397,43 +1612,143 @@ class SerialVacuumDevice(TangoDev,Logger):
             #self.dp.command_inout("DevSerWriteString",commCode)
             #self.dp.command_inout("DevSerWriteChar",[13])
             
+    def command(self,name,*args):
+        """ command_inout on the serial device, counting remote calls """
+        self.dpcalls += 1
+        return self.dp.command_inout(name,*args)
+
+    def readSerial(self):
+        """ Returns the characters pending in the serial device input buffer """
+        if self.getSerialClass() == 'PySerial':
+            self.dpcalls += 1
+            nchars = self.dp.read_attribute('InputBuffer').value
+            return self.command("Read",nchars)
+        else: #Class is 'Serial'
+            #return self.dp.command_inout("DevSerReadRaw")
+            return self.command("DevSerReadString",0)
+
+    def drainSerial(self):
+        """ Used by SerialReader thread """
+        self.openPort()
+        return self.readSerial()
+
+    def openPort(self):
+        """ Opens the PySerial port, it is kept open only in lean mode """
+        if self.getSerialClass() == 'PySerial' and not self.opened:
+            self.command("Open")
+            self.opened = self.lean
+
+    def closePort(self):
+        """ Closes the PySerial port if it was kept open (lean mode) """
+        if self.opened:
+            self.opened = False
+            try: self.command("Close")
+            except Exception,e: self.warning('closePort(): %s'%e)
+
     # If sendComm == sendCommPySerial
     def sendCommPySerial(self, commCode, READ=True):
         """ Sends a command to the serial device using the ALBA's PySerial """
         if self.trace: self.debug('In sendComm(%s): using %s class' % (commCode,self.getSerialClass()))
-        self.dp.command_inout("FlushInput")
-        self.dp.command_inout("FlushOutput")
-        self.dp.command_inout("Write",array.array('B',commCode))
+        if self.flushNeeded or not self.lean:
+            self.command("FlushInput")
+            self.command("FlushOutput")
+            self.flushNeeded = False
+        self.command("Write",array.array('B',commCode))
             
     # If sendComm == sendCommCppSerial
     def sendCommCppSerial(self, commCode, READ=True):
         """ Sends a command to the serial device using the ESRF's Tango Serial """
         if self.trace: self.debug('In sendComm(%s): using %s class' % (commCode,self.getSerialClass()))
         #if not int(time.time())%60: 
-        self.dp.command_inout("DevSerFlush",PyTango.Release().version_number<700 and '2' or 2)
+        if self.flushNeeded or not self.lean:
+            self.command("DevSerFlush",PyTango.Release().version_number<700 and '2' or 2)
+            self.flushNeeded = False
         if not commCode.endswith('\r'): commCode+='\r'
         #Using DevSerWriteChar instead of DevSerWriteString to avoid memory leaks in PyTango8
-        self.dp.command_inout("DevSerWriteChar",map(ord,commCode))
+        self.command("DevSerWriteChar",map(ord,commCode))
         #self.dp.command_inout("DevSerWriteString",commCode)
         #self.dp.command_inout("DevSerWriteChar",[13])
         
-    def readComm(self, commCode, READ=True, emulation=False):
+    def readComm(self, commCode, READ=True, emulation=False, expect=None):
+        """
+        Waits for the reply to commCode, reading it from the SerialReader buffer 
+        if it is running or polling the serial device otherwise.
+        :param expect: list of accepted replies (e.g. the ACK,NACK of a PostCommand)
+        """
+        t0,m0 = fandango.now(),monotonic()
+        if not hasattr(self,'_Dcache'):
+			self._Dcache = {}
+        if emulation and commCode in self._Dcache:
+			return self._Dcache[commCode]
+
+        timeout = self.getTimeout(commCode)
+        self.lastdata = None
+        if self.reader and self.reader.isAlive():
+            result = self.readBuffer(commCode,expect,timeout)
+        else:
+            result = self.pollBuffer(commCode,expect,timeout)
+        if self.learn and self.lastdata and result.strip() and self.lastdata-m0<timeout:
+            if commCode not in self.latencies:
+                self.latencies[commCode] = LatencyStats(self.learn,self.minWait,self.waitTime)
+            self.latencies[commCode].add(self.lastdata-m0)
+        elif self.learn and commCode in self.latencies and not result.strip():
+            self.latencies[commCode].expired()
+
+        self._Dcache[commCode] = result
+        readtime = fandango.now()-t0
+        self.maxreadtime = max((self.maxreadtime,readtime))
+        if self.trace:
+            print('ReadComm(%s) = %s done in %f seconds (max = %f, + %f)' % 
+                (commCode,result.strip(),readtime,self.maxreadtime,fandango.now()-self.lasttime))
+
+        return result
+
+    def readBuffer(self, commCode, expect=None, timeout=None):
+        """
+        Waits for the reply in the SerialReader buffer, it finishes when the reply
+        is complete (see setFraming), after timeout/4 of silence or after timeout (waitTime by default).
+        """
+        framed = bool(expect or self.terminator or self.replyLength)
+        timeout = timeout or self.waitTime
+        quiet = timeout/4.
+        result, end, lastdata = '', monotonic()+timeout, None
+        while True:
+            timeout = end-monotonic()
+            if lastdata is not None:
+                timeout = min(timeout,lastdata+quiet-monotonic())
+            if timeout<=0:
+                break
+            rec = self.reader.get(timeout)
+            if rec:
+                result += rec
+                lastdata = self.lastdata = monotonic()
+                if framed and self.isReplyComplete(commCode,result,expect):
+                    return result
+            elif lastdata is not None and not result.replace(commCode,'').strip():
+                lastdata = None #Only echo or blanks received
+        if framed or not result.strip():
+            self.flushNeeded = True
+        return result
+
+    def pollBuffer(self, commCode, expect=None, timeout=None):
         ## A WAIT TIME HAS BEEN NECESSARY BEFORE READING THE BUFFER
         # This wait is divided in smaller periods
         # In each period is tested what has been received from the serial port
         # The wait will finish when after receiving some information there's silence again
-        t0, result, retries = fandango.now(),'',0
-        if not hasattr(self,'_Dcache'): 
-			self._Dcache = {}
-        if emulation and commCode in self._Dcache: 
-			return self._Dcache[commCode]
-			
-        wtime = 0.0; result = ""; rec = ""; lastrec = ""; div=4.; 
+        # If the reply framing is known (setFraming or expect=(ACK,NACK)) the periods
+        # are shortened to framePoll and the wait finishes as soon as the reply is complete
+        waitTime = timeout or self.waitTime
+        retries = 0
+        wtime = 0.0; result = ""; rec = ""; lastrec = ""; div=4.;
         before=time.time(); after=before+0.001
-        
-        while wtime<self.waitTime and not (not len(rec) \
+        framed = bool(expect or self.terminator or self.replyLength)
+        step = min(waitTime/div,self.framePoll) if framed else waitTime/div
+        quiet = max(1,int(round(waitTime/div/step))) #Empty reads meaning end of reply
+        silent = 0
+
+        while wtime<waitTime and not (silent>=quiet \
 			and len(lastrec.replace(commCode,'').replace('\r','').replace('\n',''))):
-            
+
             #if self.trace and retries: 
             #    print('In readComm(%s)(%d) Waiting %fs for answer ...'
             #        %(commCode,retries,self.waitTime))
@@ -445,37 +1760,30 @@ class SerialVacuumDevice(TangoDev,Logger):
             
             last=before
             after=time.time()
-            pause = self.waitTime/div - (after-before)
+            pause = step - (after-before)
             fandango.wait(max(pause,0)) #time.sleep(max(pause,0))
             before=time.time();
             lastrec=lastrec+rec
             
-            if self.getSerialClass() == 'PySerial':
-                nchars = self.dp.read_attribute('InputBuffer').value
-                rec = self.dp.command_inout("Read",nchars)
-            else: #Class is 'Serial'
-                #rec = self.dp.command_inout("DevSerReadRaw")
-                rec = self.dp.command_inout("DevSerReadString",0)
-                
-            rec.rstrip().lstrip()
+            rec = self.readSerial()
             
-            lrclean = lastrec.replace(commCode,'').replace('\r','').replace('\n','')
-            rrclean = rec.replace('\r','\\r').replace('\n','\\n')
-            if self.trace and rrclean: 
+            if self.trace and rec: 
+                lrclean = lastrec.replace(commCode,'').replace('\r','').replace('\n','')
+                rrclean = rec.replace('\r','\\r').replace('\n','\\n')
                 #self.debug
                 print( 'received('+str(wtime)+';'+str(after-last)+';'
                     +str(len(lrclean))+';'+str(len(rec))+"): '" + rrclean+"'")
 					
             result += rec
-            wtime += self.waitTime/div
-
-        self._Dcache[commCode] = result
-        readtime = fandango.now()-t0
-        self.maxreadtime = max((self.maxreadtime,readtime))
-        if self.trace:
-            print('ReadComm(%s) = %s done in %f seconds (max = %f, + %f)' % 
-                (commCode,result.strip(),readtime,self.maxreadtime,fandango.now()-self.lasttime))
-
+            wtime += step
+            silent = 0 if rec else silent+1
+            if rec: self.lastdata = monotonic()
+            if framed and rec and self.isReplyComplete(commCode,result,expect):
+                break
+        else:
+            #Timeout or framing error, garbage may remain in the buffers
+            if framed or not result.strip():
+                self.flushNeeded = True
         return result
     
         
@@ -483,19 +1791,35 @@ class SerialVacuumDevice(TangoDev,Logger):
         """   It is an extended version of sendCommand, needed if a confirmation is received after the first command and a second command is needed for the value.
         The format for a PostCommand is a tuple: (Command,ACK,NACK)
         """
-        self.trace = True #not READ
+        if self.traceRate:
+            n = self.traceCounts.get(commCode,0)
+            self.traceCounts[commCode] = n+1
+            self.trace = not n%self.traceRate
         
-        try:
-            self.dp.ping()
-            self.dp.state()
-        except:
-            msg = 'serialComm(%s): serialLine %s  not available!'%(commCode,self.tangoDevice)
+        if not self.monitor.isAlive():
+            msg = 'serialComm(%s): serialLine %s  not available!: %s'%(commCode,self.tangoDevice,self.monitor.lasterror)
             self.error(msg)
             self.lastsend = self.lastrecv = ''
             raise Exception('SerialLineNotAvailable!')
-        
-        if self.getSerialClass() == 'PySerial':
-            self.dp.command_inout("Open")
+
+        self.arbiter.acquire(self.threadname or 'SVD(0x%x)'%id(self))
+        t0,result,error = monotonic(),'',None
+        try:
+            result = self.serialTransaction(commCode,READ,PostCommand)
+            return result
+        except Exception,e:
+            error = e
+            raise
+        finally:
+            self.arbiter.release()
+            duration = monotonic()-t0
+            self.metrics.transaction(commCode if READ else 'write',duration,bool(result) or not READ)
+            if self.recorder: self.recorder.write(time.time()-duration,duration,commCode,READ,result,error)
+
+    def serialTransaction(self, commCode, READ=True, PostCommand=[]):
+        """ Sends commCode and PostCommands, it must be called only from serialComm """
+        calls = self.dpcalls
+        self.openPort()
             
         ## If the command is not a READ command the answer from the device will be ignored.
         ## Later check of the writing status should be done in higher level code.
@@ -508,30 +1832,33 @@ class SerialVacuumDevice(TangoDev,Logger):
                     if result!=PostCommand[ncomm-1][2]:
                         if self.trace: self.debug('Received UNKNOWN thing: '+result)
                         self.add_new_error('%s Received UNKNOWN thing: %s' % (commCode,result))
+                        self.flushNeeded = True
                     if self.trace: self.debug( 'Received NACK: '+result)
+                    if self.getSerialClass() == 'PySerial' and not self.lean:
+                        self.command("Close")
+                    self.lastdpcalls = self.dpcalls-calls
                     return result
-                else: self.debug( 'Received ACK: '+result)
+                elif self.trace: self.debug( 'Received ACK: '+result)
             
             self.lastsend = not ncomm and commCode or PostCommand[ncomm-1][0]
-            self.sendComm(self.lastsend)
-            result=self.readComm(commCode,READ)
+            expect = PostCommand[ncomm][1:3] if ncomm<len(PostCommand) else None
+            try:
+                if self.reader:
+                    n = self.reader.clear() #Unsolicited or late bytes
+                    if n and self.trace: self.debug('serialComm(%s): %d bytes discarded'%(commCode,n))
+                self.sendComm(self.lastsend)
+                self.metrics.bytesOut += len(self.lastsend)
+                result=self.readComm(commCode,READ,expect=expect)
+                self.metrics.bytesIn += len(result)
+            except DevFailed,e:
+                self.monitor.report(False,str(e))
+                self.opened,self.flushNeeded = False,True
+                raise
+            self.monitor.report(True)
             
             ## 1-Remove blanks from the end
-            for c in reversed(result):
-                if c not in self.blankChars: break
-                result=result[0:len(result)-1]
-                #if self.trace: print 'r:',result,':r\n'
-            
             ## 2-Remove echo & blanks from the beginning
-            if commCode in result:
-                while len(commCode) and len(result) and commCode[0]==result[0]:
-                    commCode=commCode[1:]
-                    result=result[1:]
-                    #if self.trace: print 'c:',commCode,':c\nr:',result,':r\n'
-            for c in result:
-                if c not in self.blankChars: break
-                result=result[1:]
-                #if self.trace: print 'r:',result,':r\n'
+            result,commCode = stripReply(result,commCode,self.blankChars)
                 
             ## 3-The rest is the result
             self.lasttime = end = time.time()
@@ -543,11 +1870,126 @@ class SerialVacuumDevice(TangoDev,Logger):
             
         ## 4-Parse result, determine if it is number or not, etc ...
         ## It must be done in the tango device side!!!
-        if self.getSerialClass() == 'PySerial':
-            self.dp.command_inout("Close")
+        if self.getSerialClass() == 'PySerial' and not self.lean:
+            self.command("Close")
+        self.lastdpcalls = self.dpcalls-calls
         return result
 
 
+def isSerialVacuumDevice(obj):
+    """ Compares class names, the module may be imported as SerialVacuumDevice or VacuumController.SerialVacuumDevice """
+    return any(k.__name__=='SerialVacuumDevice' for k in type(obj).__mro__)
+
+def getSerialDevices(device):
+    """ Returns the SerialVacuumDevice objects used by a Tango device """
+    return [v for v in device.__dict__.values() if isSerialVacuumDevice(v)]
+
+def usesSerialDevices(device):
+    """ True if the module of a Tango device class imports SerialVacuumDevice """
+    module = sys.modules.get(device.__module__)
+    return any(getattr(v,'__name__','').split('.')[-1]=='SerialVacuumDevice' for v in vars(module).values()) if module else False
+
+def addTraceAttribute(device,device_class,name='SerialTrace'):
+    """
+    Adds a READ_WRITE attribute to a Tango device class to read and set the trace rate
+    (see SerialVacuumDevice.setTrace) of the SerialVacuumDevice objects of each device.
+    It must be called before server_init (see VacuumController.main)
+    """
+    def read(self,attr):
+        attr.set_value(max([svd.getTrace() for svd in getSerialDevices(self)] or [0]))
+    def write(self,attr):
+        rate = attr.get_write_value()
+        for svd in getSerialDevices(self): svd.setTrace(rate)
+    device_class.attr_list[name] = [[PyTango.DevLong,PyTango.SCALAR,PyTango.READ_WRITE],]
+    setattr(device,'read_'+name,read)
+    setattr(device,'write_'+name,write)
+
+def addSerialAttribute(device,device_class,name,read,dtype=PyTango.DevString,size=1024,description=''):
+    """
+    Adds a read-only spectrum attribute to a Tango device class, 
+    its value is read(svds) for the SerialVacuumDevice objects of each device.
+    """
+    def reader(self,attr):
+        attr.set_value(read(getSerialDevices(self)))
+    device_class.attr_list[name] = [[dtype,PyTango.SPECTRUM,PyTango.READ,size],{'description':description}]
+    setattr(device,'read_'+name,reader)
+
+def getSerialLines(svds,method):
+    """ Returns 'key: value' lines from the dictionaries returned by method(svd), prefixed by the serial device if there are several """
+    return ['%s%s: %s'%(svd.tangoDevice+' ' if len(svds)>1 else '',k,v) for svd in svds for k,v in sorted(method(svd).items())]
+
+def getLatencyCounts(svds):
+    """ Returns the sum of the latency histograms of all commands """
+    counts = [0]*(len(Histogram.BUCKETS)+1)
+    for svd in svds:
+        for h in svd.metrics.latency.values():
+            counts = [a+b for a,b in zip(counts,h.counts)]
+    return counts
+
+def addHistoryAttributes(device,device_class,size=100000):
+    """
+    Adds SerialHistoryCommand (READ_WRITE, 'command' or 'command[column]' to show, the first 
+    command with a history by default) and SerialHistory, an image with a [time,value] row 
+    for each sample of the selected command (see SerialVacuumDevice.setHistory).
+    """
+    def getSelection(self):
+        svds = getSerialDevices(self)
+        command = getattr(self,'SerialHistoryCommand','') or \
+            ([k for svd in svds for k in sorted(svd.histories)] or [''])[0]
+        return svds,command
+    def read_command(self,attr):
+        attr.set_value(getSelection(self)[1])
+    def write_command(self,attr):
+        command = attr.get_write_value()
+        if command and not any(command.split('[')[0] in svd.histories for svd in getSerialDevices(self)):
+            raise Exception('SVD(%s)_HistoryNotEnabled!'%command)
+        self.SerialHistoryCommand = command
+    def read_history(self,attr):
+        svds,command = getSelection(self)
+        key = command.split('[')[0]
+        column = int(command.split('[')[1].strip(']')) if '[' in command else 0
+        for svd in svds:
+            if key in svd.histories:
+                times,values = svd.getHistory(key)
+                attr.set_value(numpy.column_stack((times,values[:,column])))
+                return
+        attr.set_value(numpy.zeros((0,2)))
+    device_class.attr_list['SerialHistoryCommand'] = [[PyTango.DevString,PyTango.SCALAR,PyTango.READ_WRITE],]
+    device_class.attr_list['SerialHistory'] = [[PyTango.DevDouble,PyTango.IMAGE,PyTango.READ,2,size],
+        {'description':'[time,value] of the last readings of SerialHistoryCommand'}]
+    setattr(device,'read_SerialHistoryCommand',read_command)
+    setattr(device,'write_SerialHistoryCommand',write_command)
+    setattr(device,'read_SerialHistory',read_history)
+
+def addSerialAttributes(device,device_class):
+    """
+    Adds the attributes showing the SerialVacuumDevice objects of a Tango device class:
+    SerialTrace, SerialMetrics, SerialHistogram, SerialPeriods, SerialTimeouts, SerialBreakers, SerialEngine and SerialHistory.
+    It must be called before server_init (see VacuumController.main)
+    """
+    addTraceAttribute(device,device_class)
+    addSerialAttribute(device,device_class,'SerialMetrics',
+        lambda svds: getSerialLines(svds,lambda svd: svd.getMetrics()),
+        description='Communication counters (see SerialVacuumDevice.getMetrics)')
+    addSerialAttribute(device,device_class,'SerialHistogram',getLatencyCounts,PyTango.DevLong,len(Histogram.BUCKETS)+1,
+        description='Transactions by latency, buckets <= %s seconds and +Inf'%','.join(map(str,Histogram.BUCKETS)))
+    addSerialAttribute(device,device_class,'SerialPeriods',
+        lambda svds: getSerialLines(svds,lambda svd: svd.getPeriods()),
+        description='Effective polling period of each read command (see SerialVacuumDevice.setAdaptivePeriod)')
+    addSerialAttribute(device,device_class,'SerialTimeouts',
+        lambda svds: getSerialLines(svds,lambda svd: dict((k,'timeout=%2.4f ewma=%2.4f p99=%2.4f samples=%d'%v) 
+            for k,v in svd.getTimeouts().items())),
+        description='Learned timeout and latencies (seconds) of each command (see SerialVacuumDevice learn argument)')
+    addSerialAttribute(device,device_class,'SerialBreakers',
+        lambda svds: getSerialLines(svds,lambda svd: dict((k or 'device','%s trips=%d failures=%d'%v) 
+            for k,v in svd.getBreakers().items())),
+        description='State, trips and consecutive failures of the circuit breakers (see SerialVacuumDevice breaker argument)')
+    addSerialAttribute(device,device_class,'SerialEngine',
+        lambda svds: getSerialLines(svds,lambda svd: svd.getEngineUsage()),
+        description='Queue depth of the UpdateEngine and seconds spent updating each serial device (see SerialVacuumDevice engine argument)')
+    if numpy is not None:
+        addHistoryAttributes(device,device_class)
+
 #td = SerialVacuumDevice('alba01:10000','ws/vacuum/rocket01-1')
 #td = SerialVacuumDevice('ws/vacuum/rocket01-2')
 #td.serialComm('W') #Echo off for MidiVac
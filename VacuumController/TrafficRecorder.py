@@ -0,0 +1,72 @@
+#=============================================================================
+#
+# file :        TrafficRecorder.py
+#
+# description : Records the serial transactions of SerialVacuumDevice in a
+#               text file, they can be replayed with SerialEmulator.TrafficReplay
+#
+# project :    VacuumController Device Server
+#
+# $Author: srubio@cells.es $
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+import threading
+
+class TrafficRecorder(object):
+    """
+    Records the transactions of SerialVacuumDevice.serialComm (see its record argument)
+    in a tab separated file, a line per transaction:
+    
+        epoch  duration  R|W  OK|ERR  command  reply (or exception)
+        
+    command and reply are escaped, so the file can be read with TrafficRecorder.read()
+    and replayed with TrafficReplay.
+    """
+    def __init__(self,filename):
+        self.filename = filename
+        self.file = open(filename,'a',1)
+        self.lock = threading.Lock()
+        self.count = 0
+        
+    def write(self,t,duration,command,read=True,reply='',error=None):
+        line = '%.6f\t%.6f\t%s\t%s\t%s\t%s\n'%(t,duration,'R' if read else 'W','OK' if error is None else 'ERR',
+            str(command).encode('string_escape'),str(reply if error is None else error).encode('string_escape'))
+        with self.lock:
+            self.file.write(line)
+            self.count += 1
+            
+    def close(self):
+        self.file.close()
+        
+    @staticmethod
+    def read(filename):
+        """ Returns a list of (epoch,duration,read,ok,command,reply) tuples """
+        result = []
+        for line in open(filename):
+            fields = line.rstrip('\n').split('\t')
+            if len(fields)!=6: continue
+            t,duration,read,ok,command,reply = fields
+            result.append((float(t),float(duration),read=='R',ok=='OK',
+                command.decode('string_escape'),reply.decode('string_escape')))
+        return result
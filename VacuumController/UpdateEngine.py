@@ -0,0 +1,220 @@
+#=============================================================================
+#
+# file :        UpdateEngine.py
+#
+# description : Runs the update loop of many SerialVacuumDevice objects
+#               in a single thread.
+#
+# project :    VacuumController Device Server
+#
+# $Author: srubio@cells.es $
+#
+# copyleft :    Cells / Alba Synchrotron
+#               Bellaterra
+#               Spain
+#
+############################################################################
+#
+# This file is part of Tango-ds.
+#
+# Tango-ds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tango-ds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+import threading,time,heapq,itertools,traceback,atexit
+
+from Clock import monotonic,thread_time #thread_time may be None, then only busy time is measured
+
+class UpdateEngine(object):
+    """
+    Runs the update loop of many SerialVacuumDevice objects in a single thread,
+    instead of one updateHW thread per device.
+
+    Each device is kept in a heap ordered by the time of its next step;
+    when due, its updateStep() method is executed and the device is
+    rescheduled with the wait it returns. Devices notify() the engine when
+    a new command is queued, so a waiting device is stepped again immediately.
+
+    Serial transactions are still blocking; with a single worker a slow line 
+    delays the others, so the engine fits servers with many lightly loaded lines.
+    
+    With maxworkers>1 the engine is a pool of worker threads, one for each 
+    independent serial line (see BusArbiter) up to maxworkers; a device is 
+    never stepped by two workers at the same time and a worker skips the devices
+    whose line is being used by another worker, so a busy line keeps a single
+    worker and does not starve the others.
+
+    Workers are stopped at exit (see shutdown), before the interpreter clears the modules.
+    """
+    __instances = {}
+    MAX_WORKERS = 16
+
+    @classmethod
+    def get_instance(cls,pool=False):
+        """ Returns the engine shared by all devices of the process, a pool of workers if pool=True """
+        if not cls.__instances:
+            atexit.register(cls.shutdown)
+        if pool not in cls.__instances:
+            cls.__instances[pool] = cls('UpdatePool' if pool else 'UpdateEngine',
+                cls.MAX_WORKERS if pool else 1)
+        return cls.__instances[pool]
+
+    @classmethod
+    def shutdown(cls,timeout=1.):
+        """ Stops the workers of all engines """
+        for engine in cls.__instances.values():
+            engine.stop(timeout)
+
+    def __init__(self,name='UpdateEngine',maxworkers=1):
+        self.name = name
+        self.maxworkers = maxworkers
+        self.heap = []
+        self.devices = {} #device: (next step, urgent)
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.threads = []
+        self.lines = set() #Serial lines being used by a worker
+        self.stopped = False
+        self.steps = 0
+        self.busy = {} #device: seconds spent in updateStep
+        self.cpu = {} #device: cpu seconds spent in updateStep (if available)
+
+    @staticmethod
+    def getLine(device):
+        return getattr(getattr(device,'arbiter',None),'name',id(device))
+
+    def getWorkers(self):
+        """ Number of workers needed: one for each serial line, up to maxworkers """
+        lines = set(self.getLine(d) for d in self.devices)
+        return max(1,min(len(lines),self.maxworkers))
+
+    def getQueueDepth(self):
+        """ Number of devices waiting for a worker (due but not being stepped) """
+        now = monotonic()
+        with self.condition:
+            return len([d for d,(due,urgent) in self.devices.items() if due is not None and due<=now])
+
+    def getUsage(self,device):
+        """ Returns (busy,cpu) seconds spent in updateStep of device, cpu is None if not measured """
+        with self.condition:
+            return self.busy.get(device,0.),self.cpu.get(device,0.) if thread_time else None
+
+    def getReport(self):
+        return '%s: %d devices, %d workers, %d queued, %d steps'%(self.name,len(self.devices),
+            len(self.threads),self.getQueueDepth(),self.steps)
+
+    def _push(self,device,due,urgent=False):
+        self.devices[device] = (due,urgent)
+        heapq.heappush(self.heap,(due,next(self.counter),device))
+
+    def add(self,device):
+        """ Starts updating device, its update starts immediately """
+        with self.condition:
+            if device in self.devices:
+                return
+            self._push(device,monotonic())
+            self.busy.setdefault(device,0.)
+            self.cpu.setdefault(device,0.)
+            self.condition.notifyAll()
+            while len(self.threads)<self.getWorkers():
+                thread = threading.Thread(None,self.run,'%s-%d'%(self.name,len(self.threads)))
+                thread.setDaemon(True)
+                self.threads.append(thread)
+                thread.start()
+
+    def stop(self,timeout=1.):
+        """ Stops all workers, waiting up to timeout for the steps in progress """
+        with self.condition:
+            self.stopped = True
+            self.condition.notifyAll()
+            threads = list(self.threads)
+        end = monotonic()+timeout
+        for thread in threads:
+            thread.join(max(0,end-monotonic()))
+
+    def remove(self,device):
+        """ The device will be released in the next loop (see run) """
+        self.notify(device)
+
+    def notify(self,device):
+        """ Steps device as soon as possible, unless it is waiting for an urgent-only wakeup """
+        with self.condition:
+            if device not in self.devices:
+                return
+            due,urgent = self.devices[device]
+            if due is None or (urgent and not device.event.isSet()
+                    and not device.writeList.isUrgent()):
+                return #Being stepped or pausing between communications
+            self._push(device,monotonic(),urgent)
+            self.condition.notifyAll()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.stopped or not self.devices or len(self.threads)>self.getWorkers():
+                    self.threads.remove(threading.currentThread())
+                    self.condition.notifyAll()
+                    break
+                device,skipped,timeout = None,[],None
+                while self.heap:
+                    due,i,dev = self.heap[0]
+                    if self.devices.get(dev,(None,))[0]!=due: #Outdated entry
+                        heapq.heappop(self.heap)
+                        continue
+                    wait = due-monotonic()
+                    if wait<=0:
+                        entry = heapq.heappop(self.heap)
+                        if self.getLine(dev) in self.lines: #Line used by another worker
+                            skipped.append(entry)
+                            continue
+                        device = dev
+                        self.devices[device] = (None,False)
+                        self.lines.add(self.getLine(device))
+                        if len(self.threads)>1: self.condition.notify() #Next device to another worker
+                    else:
+                        timeout = wait
+                    break
+                for entry in skipped:
+                    heapq.heappush(self.heap,entry)
+                if device is None:
+                    self.condition.wait(timeout) #Until the next due device or a line is released
+                    continue
+
+            if device.event.isSet():
+                with self.condition:
+                    self.lines.discard(self.getLine(device))
+                    self.condition.notifyAll()
+                    self.devices.pop(device,None)
+                    self.busy.pop(device,None)
+                    self.cpu.pop(device,None)
+                try: device.stopUpdate()
+                except: 
+                    if traceback is None: break #Interpreter shutdown, module globals are cleared
+                    traceback.print_exc()
+                continue
+
+            t0,c0 = monotonic(),thread_time and thread_time()
+            try:
+                wait,urgent = device.updateStep()
+            except:
+                if traceback is None: break #Interpreter shutdown, module globals are cleared
+                traceback.print_exc()
+                wait,urgent = device.period,True
+            with self.condition:
+                self.steps += 1
+                if device in self.busy:
+                    self.busy[device] += monotonic()-t0
+                    if thread_time: self.cpu[device] += thread_time()-c0
+                self.lines.discard(self.getLine(device))
+                self._push(device,monotonic()+wait,urgent)
+                self.condition.notifyAll() #Devices of this line may be waiting
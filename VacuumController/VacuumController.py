@@ -178,6 +178,12 @@ def main():
             except:
                 print('Unable to import %s Class: %s'%(k,traceback.format_exc()))
         
+        #SerialTrace, metrics, ... attributes of the serial lines (see addSerialAttributes)
+        for k,v in locals().items():
+            if isinstance(v,type) and k+'Class' in locals() and usesSerialDevices(v):
+                try: addSerialAttributes(v,locals()[k+'Class'])
+                except: print('Unable to add Serial attributes to %s: %s'%(k,traceback.format_exc()))
+        
         U = PyTango.Util.instance()
         U.server_init()
         U.server_run()
@@ -104,7 +104,7 @@ class VacuumGauge(PseudoDev):
         #READING CHANNEL STATUS
         if att == 'channelstate':
             channels=attr_value.value #It is a list of "Channel: Status" strings
-            self.info('ChannelState received : %s'%str(channels)) #Channels is a tuple instead of a list!?!
+            self.plog('info','ChannelState received : %s',channels) #Channels is a tuple instead of a list!?!
             c_state = ''
             FLOAT = '[0-9](\.[0-9]{1,2})?[eE][+-][0-9]{2,2}$'
             if channels:
@@ -113,7 +113,7 @@ class VacuumGauge(PseudoDev):
                            or 
                        fandango.matchCl('p[0-9]',self.ChannelName) and i+1==int(self.ChannelName[1:]) #Check value index == channel number
                        ):
-                        self.info('%s => %s'%(self.ChannelName,chann))
+                        self.plog('info','%s => %s',self.ChannelName,chann)
                         c_state=chann.split(':')[-1].lower().strip()
                         new_state = fun.matchMap([
                             ('.*off',PyTango.DevState.OFF),
@@ -125,21 +125,20 @@ class VacuumGauge(PseudoDev):
                             ('.*',PyTango.DevState.UNKNOWN),
                             ], c_state)
                         break
-                self.Cache[att].time = attr_value.time
-                self.Cache[att].value = c_state.upper() #It will be 'OK' if the channel is enabled
-                self.plog('info','Updated ChannelState: %s; new state is %s'%(self.Cache[att].value,new_state))
+                self.Cache[att].set(c_state.upper(),attr_value.time,getattr(attr_value,'quality',None)) #It will be 'OK' if the channel is enabled
+                self.plog('info','Updated ChannelState: %s; new state is %s',self.Cache[att].value,new_state)
             else:
-                self.plog('warning','ChannelState received has no value!: %s'%channels)
+                self.plog('warning','ChannelState received has no value!: %s',channels)
         #READING CHANNEL VALUE
         elif att == self.ChannelName:
-            self.Cache[att] = attr_value
-            self.plog('info','Updated Pressure Value: %s at %s'%(attr_value.value,attr_value.time))
+            self.ChannelRecord.update(attr_value)
+            self.plog('info','Updated Pressure Value: %s at %s',attr_value.value,self.ChannelRecord.time)
         elif att == 'state':
-            self.Cache[att] = attr_value
+            self.Cache[att].update(attr_value)
         else: 
-            self.plog('warning','UNKNOWN ATTRIBUTE %s!!!!!'%attr_name)
-            self.plog('debug','self.ChannelName=%s'%str(self.ChannelName))
-            self.plog('debug','attr_name.split=%s'%str(attr_name.split('/')))
+            self.plog('warning','UNKNOWN ATTRIBUTE %s!!!!!',att)
+            self.plog('debug','self.ChannelName=%s',self.ChannelName)
+            self.plog('debug','att=%s',att)
         return new_state
     
     
@@ -174,11 +173,7 @@ class VacuumGauge(PseudoDev):
                 self.ChannelName = (self.Channel.split()[0] if fun.isString(self.Channel) else fun.first(c for c in self.Channel if c.lower() not in ('State','ChannelState'))).lower()
                 targets = ['State',self.ChannelName,'ChannelState']                
                 self.debug('Creating cache values for %s:%s' % (self.GaugeController,targets))                
-                for attribute in targets:
-                    da = PyTango.DeviceAttribute()
-                    da.name,da.time,da.value = (self.GaugeController+'/'+attribute),PyTango.TimeVal.fromtimestamp(0),None
-                    self.Cache[attribute] = da
-                    self.Errors[attribute] = 0
+                self.ChannelRecord,self.ChannelStateRecord = self.create_cache(self.GaugeController,targets)[1:]
                     
                 self.subscribe_external_attributes(self.GaugeController,targets)
             
@@ -233,9 +228,9 @@ class VacuumGauge(PseudoDev):
         #attr.set_value(attr_Pressure_read)
         state=self.dev_state()
         #av = self.ExternalAttributes[(self.GaugeController+'/'+self.Channel).lower()].read() #Reading from Tau or Cache should be the same
-        av = self.Cache[self.ChannelName]
-        value,date = av.value,av.time if not hasattr(av.time,'totime') else av.time.totime()
-        if not self.LowRange or not fun.matchCl('lo.*',str(self.Cache['ChannelState'].value)):
+        value,date = self.ChannelRecord.get()[:2]
+        cstate,cdate = self.ChannelStateRecord.get()[:2]
+        if not self.LowRange or not fun.matchCl('lo.*',str(cstate)):
             quality = fun.matchMap([
                 ('ON|MOVING',
                     PyTango.AttrQuality.ATTR_VALID),
@@ -247,7 +242,7 @@ class VacuumGauge(PseudoDev):
         
         else: #If Status==LOW, then the pressure value is replaced by the LowRange value (wanted like this for pressure profile visualization)
             value,quality = min([self.LowRange,(value or self.LowRange)]),PyTango.AttrQuality.ATTR_ALARM
-            date = self.Cache['ChannelState'].time if not hasattr(self.Cache['ChannelState'].time,'totime') else self.Cache['ChannelState'].time.totime()
+            date = cdate
             
         self.debug('read_Pressure(): state is %s, value is %s, quality is %s.'%(state,value,quality))
         if 'set_attribute_value_date_quality' in dir(PyTango):
@@ -275,16 +270,16 @@ class VacuumGauge(PseudoDev):
         self.debug("In read_ChannelStatus()")
 
         state=self.dev_state()
-        av = self.Cache['ChannelState']
-        pressure = (self.Cache[self.ChannelName].value or 0.)
-        self.debug("In read_ChannelStatus(): %s.ChannelState.read() = %s"%(self.GaugeController,av.value))
+        cstate,date = self.ChannelStateRecord.get()[:2]
+        pressure = (self.ChannelRecord.value or 0.)
+        self.debug("In read_ChannelStatus(): %s.ChannelState.read() = %s"%(self.GaugeController,cstate))
         value,quality = fun.matchMap([
             ('ON|MOVING',
                 ('%3.2e mbar'%pressure if (self.LowRange and pressure>self.LowRange) else 'LO<%1.1e'%self.LowRange,PyTango.AttrQuality.ATTR_VALID)),
             ('INIT|UNKNOWN',
                 (str(state),PyTango.AttrQuality.ATTR_ALARM)),
             ('.*',
-                (av.value,PyTango.AttrQuality.ATTR_ALARM)),
+                (cstate,PyTango.AttrQuality.ATTR_ALARM)),
             ],state)        
         
         self.ChannelStatus = value
@@ -293,7 +288,6 @@ class VacuumGauge(PseudoDev):
             if 'set_attribute_value_date_quality' in dir(PyTango):
                 PyTango.set_attribute_value_date_quality(attr,value,date,quality)
             else: 
-                date = av.time if not hasattr(av.time,'totime') else av.time.totime()
                 attr.set_value_date_quality(value,date,quality)   
 
 
@@ -373,6 +367,10 @@ class VacuumGaugeClass(PyTango.PyDeviceClass):
             [PyTango.DevBoolean,
             "true/false",
             [False] ],
+        'CoalesceEvents':
+            [PyTango.DevBoolean,
+            "If true, events are processed in a separate thread and only the last event of each attribute is kept while waiting",
+            [False] ],
         'PollingCycle': #2013, added from PyStateComposer
             [PyTango.DevLong,
             "Default period for polling all device states.",
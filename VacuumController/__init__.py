@@ -1,8 +1,9 @@
-__all__ = ['SerialVacuumDevice','PseudoDev','getExpNumbers','TangoDev','VacuumGauge','IonPump']
+__all__ = ['SerialVacuumDevice','PseudoDev','getExpNumbers','decodeChannels','decodeReplies','addTraceAttribute','addSerialAttributes','TangoDev','BlackBoxFile','SerialEmulator','TrafficRecorder','VacuumGauge','IonPump']
 
 from PseudoDev import *
 from TangoDev import *
 from VacuumGauge import *
 from IonPump import *
 from SerialVacuumDevice import *
+from SerialEmulator import *
 